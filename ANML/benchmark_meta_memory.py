@@ -0,0 +1,92 @@
+import argparse
+import logging
+import multiprocessing
+import resource
+import time
+
+import torch
+
+import model.modelfactory as mf
+import utils.utils as utils
+from model.meta_learner import MetaLearingClassification
+
+logger = logging.getLogger('experiment')
+
+
+def run(args, interval):
+    """
+    Meta steps on random Omniglot-shaped episodes with the given checkpoint interval.
+    :return: seconds per meta step, peak memory in MB (CUDA allocations on GPU, resident set size on CPU)
+    """
+    utils.set_seed(args.seed)
+    args.grad_checkpoint_interval = interval
+
+    if torch.cuda.is_available():
+        device = torch.device('cuda')
+    else:
+        device = torch.device('cpu')
+
+    config = mf.ModelFactory.get_model(args.treatment, "omniglot", k_nm=args.ksplit)
+    maml = MetaLearingClassification(args, config, args.treatment).to(device)
+    utils.freeze_layers(args.rln, maml)
+
+    classes = config[-1][1][0]
+    x_traj = torch.randn(args.update_step, 1, 3, 28, 28, device=device)
+    y_traj = torch.randint(classes, (args.update_step, 1), device=device)
+    x_rand = torch.randn(1, 64 + args.update_step, 3, 28, 28, device=device)
+    y_rand = torch.randint(classes, (1, 64 + args.update_step), device=device)
+
+    # Warm-up step, not timed
+    maml(x_traj, y_traj, x_rand, y_rand)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+
+    start = time.time()
+    for _ in range(args.steps):
+        maml(x_traj, y_traj, x_rand, y_rand)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    elapsed = (time.time() - start) / args.steps
+
+    if torch.cuda.is_available():
+        peak = torch.cuda.max_memory_allocated() / 2 ** 20
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+    return elapsed, peak
+
+
+def main(args):
+    # Every setting runs in a fresh process so that peak memory is not shared between them
+    context = multiprocessing.get_context('spawn')
+    print("interval  s/step  peak MB")
+    for interval in args.intervals:
+        with context.Pool(1) as pool:
+            elapsed, peak = pool.apply(run, (args, interval))
+        print("%8s  %6.3f  %7.1f" % (interval or "off", elapsed, peak))
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        description='Time and peak memory of meta steps for several --grad_checkpoint_interval values')
+    argparser.add_argument('--intervals', type=int, nargs='+', default=[0, 1, 2, 5, 10],
+                           help='checkpoint intervals to compare, 0 is the current behaviour')
+    argparser.add_argument('--steps', type=int, help='timed meta steps per setting', default=5)
+    argparser.add_argument('--treatment', help='Neuromodulation or OML', default='Neuromodulation')
+    argparser.add_argument('--seed', type=int, help='Seed for random', default=10000)
+    argparser.add_argument('--ksplit', type=int, help='number of char per alphabet', default=5)
+    argparser.add_argument('--meta_lr', type=float, help='meta-level outer learning rate', default=1e-2)
+    argparser.add_argument('--update_lr', type=float, help='task-level inner update learning rate', default=0.01)
+    argparser.add_argument('--update_step', type=int, help='task-level inner update steps', default=20)
+    argparser.add_argument('--meta_grad', choices=['first_order', 'full', 'truncated'], default='full',
+                           help='meta-gradient mode, see mrcl_classification.py')
+    argparser.add_argument('--truncate_steps', type=int, default=5)
+    argparser.add_argument("--rln", type=int, default=9)
+    argparser.add_argument("--batched", action="store_true", help='run the neuromodulated network on whole batches')
+    argparser.add_argument("--fuse_stem", action="store_true")
+    argparser.add_argument('--gate_threshold', type=float, default=None)
+    argparser.add_argument("--reuse_prefix", action="store_true")
+    args = argparser.parse_args()
+
+    print(args)
+    main(args)
@@ -0,0 +1,181 @@
+import argparse
+import logging
+
+import torch
+
+import model.learner as Learner
+import model.modelfactory as mf
+import model.quantized_learner as ql
+
+logger = logging.getLogger('experiment')
+
+# Small config with batch norms after a convolution and a linear layer, the ones Learner.export folds
+BN_CONFIG = [
+    ('conv2d', [16, 3, 3, 3, 1, 0]),
+    ('bn', [16]),
+    ('relu', [True]),
+    ('max_pool2d', [2, 2, 0]),
+    ('flatten', []),
+    ('rep', []),
+    ('linear', [64, 16 * 13 * 13]),
+    ('bn', [64]),
+    ('relu', [True]),
+    ('linear', [100, 64]),
+]
+
+
+def random_learner(args, treatment):
+    """
+    :return: Learner with the Omniglot config of treatment (BN_CONFIG for 'bn'), random weights and non-trivial
+    batch norm parameters and running statistics
+    """
+    if treatment == 'bn':
+        config = BN_CONFIG
+    else:
+        config = mf.ModelFactory.get_model(treatment, "omniglot", k_nm=args.ksplit)
+    net = Learner.Learner(config, args.ksplit, treatment == "Neuromodulation")
+    with torch.no_grad():
+        for p in net.vars:
+            if p.dim() == 1:
+                p.add_(0.1 * torch.randn_like(p))
+        for idx in range(0, len(net.vars_bn), 2):
+            net.vars_bn[idx].normal_(0, 0.1)
+            net.vars_bn[idx + 1].uniform_(0.5, 2)
+    return net
+
+
+def random_batch(args, net, size):
+    """
+    :return: images [size, 3, 28, 28] and the task index of every image
+    """
+    x = torch.randn(size, 3, 28, 28)
+    tasks = torch.zeros(size, dtype=torch.long)
+    if net.task_masks is not None:
+        tasks = torch.randint(len(net.task_masks), (size,))
+    return x, tasks
+
+
+def compare(args, outputs, expected):
+    """
+    :return: largest absolute difference, whether the outputs match up to floating point reordering
+    """
+    return (outputs - expected).abs().max().item(), torch.allclose(outputs, expected, rtol=args.rtol, atol=args.atol)
+
+
+def check_batched(args, net):
+    """
+    Whole batch through one pass (Learner.batched) against every image on its own.
+    """
+    x, tasks = random_batch(args, net, args.batch_size)
+    with torch.no_grad():
+        net.batched = False
+        expected = torch.cat([net(x[i:i + 1], tasks[i:i + 1], bn_training=False) for i in range(len(x))])
+        net.batched = True
+        outputs = net(x, tasks, bn_training=False)
+    return compare(args, outputs, expected)
+
+
+def check_fuse_stem(args, net):
+    """
+    Fused first convolution of the neuromodulatory and prediction networks against the two separate ones. Configs
+    without a fusable stem run the same plan either way.
+    """
+    x, tasks = random_batch(args, net, args.batch_size)
+    with torch.no_grad():
+        net.fuse_stem = False
+        expected = net(x, tasks, bn_training=False)
+        net.fuse_stem = True
+        outputs = net(x, tasks, bn_training=False)
+    return compare(args, outputs, expected)
+
+
+def check_export(args, net):
+    """
+    Inference copy of Learner.export, with its batch norms folded, against the original model with running
+    statistics.
+    """
+    x, tasks = random_batch(args, net, args.batch_size)
+    with torch.no_grad():
+        expected = net(x, tasks, bn_training=False)
+        outputs = net.export()(x, tasks, bn_training=False)
+    return compare(args, outputs, expected)
+
+
+def check_prefix(args, net):
+    """
+    forward_prefix followed by forward_suffix against forward, for every split point of the layers.
+    """
+    x, tasks = random_batch(args, net, args.batch_size)
+    results = []
+    with torch.no_grad():
+        expected = net(x, tasks, bn_training=False)
+        for layers in range(len(net.vars) // 2 + 1):
+            state = net.forward_prefix(x, layers, bn_training=False)
+            results.append(compare(args, net.forward_suffix(state, tasks, layers, bn_training=False), expected))
+    return max(delta for delta, _ in results), all(ok for _, ok in results)
+
+
+def check_quantization(args, net):
+    """
+    int8 copy of net against the fp32 forward. Quantization is lossy, so the logits only have to agree up to
+    args.tolerance times their largest magnitude.
+    :return: largest absolute difference, whether it is within the tolerance
+    """
+    calibration = torch.utils.data.TensorDataset(torch.randn(args.calibration_size, 3, 28, 28),
+                                                 torch.zeros(args.calibration_size, dtype=torch.long))
+    qnet = ql.quantize(net, calibration)
+
+    x, tasks = random_batch(args, net, args.batch_size)
+    with torch.no_grad():
+        expected = net(x, tasks, bn_training=False)
+        logits = qnet(x, tasks)
+    atol = args.tolerance * expected.abs().max().item()
+    agreement = (logits.argmax(dim=1) == expected.argmax(dim=1)).float().mean().item()
+    logger.info("int8 top-1 agrees with fp32 on %.2f of the images", agreement)
+    return (logits - expected).abs().max().item(), torch.allclose(logits, expected, rtol=0, atol=atol)
+
+
+CHECKS = {
+    'batched': check_batched,
+    'export': check_export,
+    'prefix': check_prefix,
+    'fuse_stem': check_fuse_stem,
+    'quantization': check_quantization,
+}
+
+
+def main(args):
+    failed = 0
+    print("%-12s  %-15s  %10s  %s" % ("check", "treatment", "max |diff|", "result"))
+    for treatment in args.treatments:
+        for name in args.checks:
+            torch.manual_seed(args.seed)
+            delta, ok = CHECKS[name](args, random_learner(args, treatment))
+            failed += not ok
+            print("%-12s  %-15s  %10.2e  %s" % (name, treatment, delta, "ok" if ok else "FAILED"))
+    if failed:
+        raise SystemExit("%d checks failed" % failed)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        description='Compare the outputs of the optimised Learner paths with the reference forward on random models')
+    argparser.add_argument('--checks', nargs='+', choices=sorted(CHECKS), default=sorted(CHECKS),
+                           help='paths to check, all by default')
+    argparser.add_argument('--treatments', nargs='+', choices=['Neuromodulation', 'OML', 'bn'],
+                           default=['Neuromodulation', 'OML', 'bn'],
+                           help='configs of the random models, bn is a small one with foldable batch norms')
+    argparser.add_argument('--seed', type=int, help='Seed for random', default=10000)
+    argparser.add_argument('--ksplit', type=int, help='number of char per alphabet', default=5)
+    argparser.add_argument('--batch_size', type=int, help='random images per check', default=16)
+    argparser.add_argument('--calibration_size', type=int, default=64,
+                           help='random images the int8 activation ranges are calibrated on')
+    argparser.add_argument('--tolerance', type=float, default=0.1,
+                           help='largest int8 logit error, relative to the largest fp32 logit')
+    argparser.add_argument('--rtol', type=float, default=1e-4, help='relative tolerance of the exact checks')
+    argparser.add_argument('--atol', type=float, default=1e-5, help='absolute tolerance of the exact checks')
+    args = argparser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    print(args)
+    main(args)
@@ -1,5 +1,3 @@
-import torchvision.transforms as transforms
-
 import datasets.omniglot as om
 
 
@@ -8,17 +6,18 @@ class DatasetFactory:
         pass
 
     @staticmethod
-    def get_dataset(name, ksplit: int, train=True, path=None, background=True, all=False):
+    def get_dataset(name, ksplit: int, train=True, path=None, background=True, all=False, cache=False,
+                    compact=False, deep_verify=False, zip_storage=False):
 
         if name == "omniglot":
-            train_transform = transforms.Compose(
-                [transforms.Resize((84, 84)),
-                 transforms.ToTensor()])
             if path is None:
                 return om.Omniglot("../data/omni", ksplit, background=background, download=True, train=train,
-                                   transform=train_transform, all=all)
+                                   all=all, cache=cache, compact=compact,
+                                   deep_verify=deep_verify, zip_storage=zip_storage)
             else:
-                return om.Omniglot(path, ksplit, download=True, background=train, transform=train_transform)
+                return om.Omniglot(path, ksplit, download=True, background=train,
+                                   cache=cache, compact=compact, deep_verify=deep_verify,
+                                   zip_storage=zip_storage)
 
         else:
             print("Unsupported Dataset")
@@ -1,14 +1,16 @@
 from __future__ import print_function
 
 import os
+from itertools import chain
 from os.path import join
 
 import numpy as np
+import torch
 import torch.utils.data as data
-from PIL import Image
 
-import torchvision.transforms as transforms
-from .utils import download_url, check_integrity, list_dir, list_files
+from .omniglot_cache import OmniglotCache, build_cache, load_image, manifest_path, tree_stamp
+from .omniglot_zip import ZipFolder
+from .utils import download_url, check_integrity_stamped, list_dir, list_files, makedir_exist_ok
 
 
 class Omniglot(data.Dataset):
@@ -18,13 +20,21 @@ class Omniglot(data.Dataset):
             ``omniglot-py`` exists.
         background (bool, optional): If True, creates dataset from the "background" set, otherwise
             creates from the "evaluation" set. This terminology is defined by the authors.
-        transform (callable, optional): A function/transform that  takes in an PIL image
-            and returns a transformed version. E.g, ``transforms.RandomCrop``
+        transform (callable, optional): Unused, images are transformed per batch by the collate_fn,
+            see datasets.omniglot_cache.Collate.
         target_transform (callable, optional): A function/transform that takes in the
             target and transforms it.
         download (bool, optional): If true, downloads the dataset zip files from the internet and
             puts it in root directory. If the zip files are already downloaded, they are not
             downloaded again.
+        cache (bool, optional): If true, reads the preprocessed images from the memory-mapped cache of
+            datasets.omniglot_cache, building it first if needed.
+        compact (bool, optional): If true, reads the uint8 single channel cache (implies cache). Batches
+            of these images are expanded by datasets.omniglot_cache.expand, once per batch on the device.
+        deep_verify (bool, optional): If true, hashes the zip file again even if it was verified before
+            and has not changed since (see datasets.utils.check_integrity_stamped).
+        zip_storage (bool, optional): If true, reads the images straight from the zip file instead of
+            extracting it (see datasets.omniglot_zip). Can be combined with cache.
     """
     folder = 'omniglot-py'
     download_url_prefix = 'https://github.com/brendenlake/omniglot/raw/master/python'
@@ -35,66 +45,110 @@ class Omniglot(data.Dataset):
 
     def __init__(self, root, ksplit: int, background=True,
                  transform=None, target_transform=None,
-                 download=False, train=True, all=False):
+                 download=False, train=True, all=False, cache=False, compact=False, deep_verify=False,
+                 zip_storage=False):
         self.root = join(os.path.expanduser(root), self.folder)
         self.background = background
         self.transform = transform
         self.target_transform = target_transform
         self.images_cached = {}
         self.ksplit = ksplit
+        self.deep_verify = deep_verify
+        self.zip_storage = zip_storage
 
         if download:
             self.download()
 
-        if not self._check_integrity():
+        # After download the zip has just been verified
+        if not self._check_integrity(deep=deep_verify and not download):
             raise RuntimeError('Dataset not found or corrupted.' +
                                ' You can use download=True to download it')
 
         self.target_folder = join(self.root, self._get_target_folder())
-        self._alphabets = list_dir(self.target_folder)
-        if self.ksplit < 2:
-            self._characters = sum([[join(a, c) for c in list_dir(join(self.target_folder, a))]
-                                for a in self._alphabets], [])
-        else:
-            langu = [[join(a, c) for c in list_dir(join(self.target_folder, a))] for a in self._alphabets]
-            for item in langu:
-                a = len(item)
-                if a % self.ksplit > 0:
-                    del item[-(a % self.ksplit):]
-            self._characters = sum(langu, [])
-        self._character_images = [[(image, idx) for image in list_files(join(self.target_folder, character), '.png')]
-                                  for idx, character in enumerate(self._characters)]
-        self._flat_character_images = sum(self._character_images, [])
-        self.data = [x[0] for x in self._flat_character_images]
-        self.targets = [x[1] for x in self._flat_character_images]
-        self.data2 = []
-        self.targets2 = []
-        self.new_flat = []
-
-
-        for a in range(int(len(self.targets) / 20)):
-            start = a * 20
-            if train:
-                for b in range(start, start + 15):
-                    self.data2.append(self.data[b])
-                    self.targets2.append(self.targets[b])
-                    self.new_flat.append(self._flat_character_images[b])
-            else:
-                for b in range(start+15, start+20):
-                    self.data2.append(self.data[b])
-                    self.targets2.append(self.targets[b])
-                    self.new_flat.append(self._flat_character_images[b])
-
-        if all:
-            pass
-        else:
-            self._flat_character_images = self.new_flat
-            self.targets = self.targets2
-            print(self.targets[0:30])
-            self.data = self.data2
+        self.archive = None
+        if zip_storage:
+            self.archive = ZipFolder(join(self.root, self._get_target_folder() + '.zip'))
+        stamp = tree_stamp(self.root, self._get_target_folder(), self.archive)
+        split = 'all' if all else ('train' if train else 'test')
+        self._characters, self.data, self.targets = self._load_manifest(split, stamp)
+        self.cache = None
+        if cache or compact:
+            self.cache = self._load_cache(compact, stamp)
 
         print("Total classes = ", np.max(self.targets))
 
+    def _load_manifest(self, split, stamp):
+        """
+        Index of the split, read from the manifest saved by the first construction with the same root, ksplit,
+        background and split. It is rebuilt when the image tree changes.
+        :param split: 'train', 'test' or 'all'
+        :param stamp: datasets.omniglot_cache.tree_stamp of the images
+        :return: character directories, file name and class of every image as arrays
+        """
+        path = manifest_path(self.root, self._get_target_folder(), self.ksplit, split)
+        if os.path.isfile(path):
+            manifest = np.load(path)
+            if str(manifest['stamp']) == stamp:
+                return manifest['characters'].tolist(), manifest['data'], manifest['targets']
+
+        characters, data, targets = self._scan(split)
+        # Written under a temporary name, several processes may build the same manifest
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            makedir_exist_ok(os.path.dirname(path))
+            with open(tmp, 'wb') as f:
+                np.savez(f, stamp=stamp, characters=np.array(characters), data=data, targets=targets)
+            os.replace(tmp, path)
+        except OSError:
+            # e.g. a read-only dataset directory, the split is then scanned on every construction
+            pass
+        return characters, data, targets
+
+    def _load_cache(self, compact, stamp):
+        """
+        Opens the image cache, after building it, or updating it incrementally when it was built from another
+        version of the image tree or misses images of the split.
+        """
+        folder = self._get_target_folder()
+        cache = None
+        if OmniglotCache.exists(self.root, folder, compact):
+            cache = OmniglotCache(self.root, folder, compact)
+        if cache is None or cache.stamp != stamp or not cache.covers(self._characters, self.data, self.targets):
+            build_cache(self.root, folder, compact, archive=self.archive)
+            cache = OmniglotCache(self.root, folder, compact)
+        return cache
+
+    def _scan(self, split):
+        # Listings are sorted, so that the class ids and splits do not depend on the storage
+        characters = []
+        for a in sorted(self._list_dir('')):
+            langu = [join(a, c) for c in sorted(self._list_dir(a))]
+            # Only whole groups of ksplit characters are kept per alphabet
+            if self.ksplit >= 2 and len(langu) % self.ksplit > 0:
+                del langu[-(len(langu) % self.ksplit):]
+            characters.extend(langu)
+        files = [sorted(self._list_files(character)) for character in characters]
+        data = np.array(list(chain.from_iterable(files)))
+        targets = np.repeat(np.arange(len(characters), dtype=np.int64), [len(f) for f in files])
+
+        if split != 'all':
+            # Every character has 20 images, the first 15 are for training and the last 5 for testing
+            position = np.arange(len(targets) // 20 * 20) % 20
+            keep = position < 15 if split == 'train' else position >= 15
+            data, targets = data[:len(keep)][keep], targets[:len(keep)][keep]
+        return characters, data, targets
+
+    def _list_dir(self, path):
+        # path is relative to the image folder, in the archive or on disk
+        if self.archive is not None:
+            return self.archive.list_dir(join(self._get_target_folder(), path))
+        return list_dir(join(self.target_folder, path))
+
+    def _list_files(self, path):
+        if self.archive is not None:
+            return self.archive.list_files(join(self._get_target_folder(), path), '.png')
+        return list_files(join(self.target_folder, path), '.png')
+
     def __len__(self):
         return len(self.data)
 
@@ -103,27 +157,28 @@ class Omniglot(data.Dataset):
         Args:
             index (int): Index
         Returns:
-            tuple: (image, target) where target is index of the target character class.
+            tuple: (image, target) where target is index of the target character class. The image is
+            the stored one: a [1, 28, 28] uint8 tensor, or a normalised [3, 28, 28] float tensor from a
+            float cache, to be batched by datasets.omniglot_cache.collate.
         """
 
         image_name = self.data[index]
-        character_class = self.targets[index]
-        image_path = join(self.target_folder, self._characters[character_class], image_name)
-        if image_path not in self.images_cached:
-
-            image = Image.open(image_path, mode='r').convert('RGB')#L
-            image = image.resize((28, 28), resample=Image.LANCZOS)
-            normalize = transforms.Normalize(mean=[0.92206*256, 0.92206*256, 0.92206*256], std=[0.08426*256*256, 0.08426*256*256, 0.08426*256*256]) # adjust means and std of input data 
-            self.transform = transforms.Compose([transforms.ToTensor(), normalize])
-            if self.transform is not None:
-                image = self.transform(image)
-
-            self.images_cached[image_path] = image
+        character_class = int(self.targets[index])
+        character = self._characters[character_class]
+        if self.cache is not None:
+            image = self.cache.get(character, image_name)
         else:
-            image = self.images_cached[image_path]
-
-            if self.transform:
-                image = self.transform(image)
+            key = join(character, image_name)
+            image = self.images_cached.get(key)
+            if image is None:
+                # Kept as decoded, the float conversion and normalisation are done per batch on the
+                # model's device, see datasets.omniglot_cache.expand
+                if self.archive is not None:
+                    image_file = self.archive.open(join(self._get_target_folder(), key))
+                else:
+                    image_file = join(self.target_folder, key)
+                image = torch.from_numpy(load_image(image_file, compact=True))
+                self.images_cached[key] = image
 
         if self.target_transform:
             character_class = self.target_transform(character_class)
@@ -133,16 +188,16 @@ class Omniglot(data.Dataset):
     def _cache_data(self):
         pass
 
-    def _check_integrity(self):
+    def _check_integrity(self, deep=False):
         zip_filename = self._get_target_folder()
-        if not check_integrity(join(self.root, zip_filename + '.zip'), self.zips_md5[zip_filename]):
+        if not check_integrity_stamped(join(self.root, zip_filename + '.zip'), self.zips_md5[zip_filename], deep):
             return False
         return True
 
     def download(self):
         import zipfile
 
-        if self._check_integrity():
+        if self._check_integrity(self.deep_verify):
             print('Files already downloaded and verified')
             return
 
@@ -150,6 +205,8 @@ class Omniglot(data.Dataset):
         zip_filename = filename + '.zip'
         url = self.download_url_prefix + '/' + zip_filename
         download_url(url, self.root, zip_filename, self.zips_md5[filename])
+        if self.zip_storage:
+            return
         print('Extracting downloaded file: ' + join(self.root, zip_filename))
         with zipfile.ZipFile(join(self.root, zip_filename), 'r') as zip_file:
             zip_file.extractall(self.root)
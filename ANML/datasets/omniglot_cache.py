@@ -0,0 +1,307 @@
+import argparse
+import hashlib
+import io
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from os.path import join
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+from torch.utils.data.dataloader import default_collate
+
+from .omniglot_zip import ZipFolder
+from .utils import list_dir, makedir_exist_ok
+
+logger = logging.getLogger("experiment")
+
+# Bump when the preprocessing below changes, older caches are then rebuilt
+CACHE_VERSION = 2
+# Bump when the order or the split of the Omniglot manifests changes
+MANIFEST_VERSION = 2
+
+# Normalisation of the Omniglot images, done by expand for batches of uint8 images
+MEAN = 0.92206 * 256
+STD = 0.08426 * 256 * 256
+normalize = transforms.Normalize(mean=[MEAN, MEAN, MEAN], std=[STD, STD, STD])
+transform = transforms.Compose([transforms.ToTensor(), normalize])
+
+
+def cache_paths(root, folder, compact=False):
+    """
+    :param root: omniglot-py directory
+    :param folder: images_background or images_evaluation
+    :param compact: the uint8 single channel variant
+    :return: paths of the image array and of its index
+    """
+    directory = join(root, 'cache', 'v%d' % CACHE_VERSION)
+    if compact:
+        folder = folder + '_uint8'
+    return join(directory, folder + '.npy'), join(directory, folder + '_index.npz')
+
+
+def manifest_path(root, folder, ksplit, split):
+    """
+    :param split: 'train', 'test' or 'all'
+    :return: path of the index of an Omniglot split, see Omniglot._load_manifest
+    """
+    return join(root, 'cache', 'v%d' % CACHE_VERSION,
+                '%s_k%d_%s_manifest_v%d.npz' % (folder, ksplit, split, MANIFEST_VERSION))
+
+
+def load_image(path, compact=False):
+    """
+    Decodes one png and resizes it to 28x28, then normalises it unless compact.
+    :param path: path or file object of the png
+    :param compact: skip the normalisation and the copies to three channels
+    :return: [3, 28, 28] float32 array, or [1, 28, 28] uint8 array if compact
+    """
+    if compact:
+        # The three channels of the RGB conversion are identical for the grayscale Omniglot pngs
+        image = Image.open(path, mode='r').convert('L')
+        image = image.resize((28, 28), resample=Image.LANCZOS)
+        return np.asarray(image, dtype=np.uint8)[None]
+    image = Image.open(path, mode='r').convert('RGB')
+    image = image.resize((28, 28), resample=Image.LANCZOS)
+    return transform(image).numpy()
+
+
+def expand(images):
+    """
+    Float conversion and normalisation of a batch of compact images, to be done once per batch. The training and
+    evaluation loops call it after moving batches to the GPU, so that they are copied as uint8.
+    :param images: [..., 1, 28, 28] uint8 tensor; tensors of other types are returned unchanged
+    :return: [b, 1, 28, 28] float tensor. It stays single channel, the Learner handles one channel images as
+    three identical ones.
+    """
+    if images.dtype != torch.uint8:
+        return images
+    return (images.float() / 255 - MEAN) / STD
+
+
+class Collate:
+    """
+    collate_fn for the DataLoaders of Omniglot. Without transform, the batch keeps the stored images, e.g. uint8 ones,
+    which the training and evaluation loops expand on the device (see expand), so that the host to device copy stays
+    4 times smaller than a float one. With transform, the images are expanded and go through it on the host, once
+    per batch as tensor operations instead of once per image.
+    """
+
+    def __init__(self, transform=None):
+        """
+        :param transform: function of a [b, c, 28, 28] float tensor, e.g. an augmentation
+        """
+        self.transform = transform
+
+    def __call__(self, batch):
+        batch = default_collate(batch)
+        if self.transform is None:
+            return batch
+        return [self.transform(expand(batch[0]))] + list(batch[1:])
+
+
+# Without transform, the collate_fn of the training and evaluation scripts
+collate = Collate()
+
+
+def scan(target_folder):
+    """
+    Lists the pngs of an Omniglot folder with their modification time and size, taken from the directory listing.
+    :return: sorted alphabet/character directories, (character index, file name, mtime in ns, size) of every png
+    """
+    characters = sorted(join(a, c) for a in list_dir(target_folder) for c in list_dir(join(target_folder, a)))
+    rows = []
+    for idx, character in enumerate(characters):
+        with os.scandir(join(target_folder, character)) as entries:
+            files = sorted((e for e in entries if e.name.endswith('.png') and e.is_file()), key=lambda e: e.name)
+            for e in files:
+                stat = e.stat()
+                rows.append((idx, e.name, stat.st_mtime_ns, stat.st_size))
+    return characters, rows
+
+
+def tree_stamp(root, folder, archive=None):
+    """
+    :param archive: datasets.omniglot_zip.ZipFolder the images are read from, if any
+    :return: the mtime of the zip, or a hash of the mtimes of the image folder and of every alphabet and character
+    directory, one of which changes whenever a character or a png is added, removed or replaced
+    """
+    if archive is not None:
+        return str(os.stat(archive.zip_path).st_mtime_ns)
+    target_folder = join(root, folder)
+    stamp = hashlib.sha1(str(os.stat(target_folder).st_mtime_ns).encode())
+    with os.scandir(target_folder) as alphabets:
+        for a in sorted((e for e in alphabets if e.is_dir()), key=lambda e: e.name):
+            stamp.update(('%s %d' % (a.name, a.stat().st_mtime_ns)).encode())
+            with os.scandir(a.path) as characters:
+                for c in sorted((e for e in characters if e.is_dir()), key=lambda e: e.name):
+                    stamp.update(('%s/%s %d' % (a.name, c.name, c.stat().st_mtime_ns)).encode())
+    return stamp.hexdigest()
+
+
+def load_manifest(root, folder, compact=False):
+    """
+    :return: dict of (character, file) to (row, mtime, size, hash) for the images of an existing cache, empty if
+    there is none
+    """
+    if not OmniglotCache.exists(root, folder, compact):
+        return {}
+    index = np.load(cache_paths(root, folder, compact)[1])
+    characters = index['characters'].tolist()
+    return {(characters[idx], f): (row, mtime, size, digest) for row, (idx, f, mtime, size, digest) in
+            enumerate(zip(index['character'].tolist(), index['files'].tolist(), index['mtime'].tolist(),
+                          index['size'].tolist(), index['hash'].tolist()))}
+
+
+def _preprocess(source, compact, known_hash):
+    # Runs in the worker processes of build_cache. The file is read once, for both the hash and the decoding.
+    # source is either a path or the content of a zip member
+    if isinstance(source, bytes):
+        data = source
+    else:
+        with open(source, 'rb') as f:
+            data = f.read()
+    digest = hashlib.sha1(data).hexdigest()
+    if digest == known_hash:
+        return digest, None
+    return digest, load_image(io.BytesIO(data), compact)
+
+
+def build_cache(root, folder, compact=False, workers=None, archive=None):
+    """
+    Preprocesses every image of the folder into one array file, with an index holding the character directory, file
+    name, mtime, size and hash of every row. The build is incremental: images whose mtime and size did not change
+    are copied from the previous cache, the others are hashed again and only decoded if their content changed.
+    Both files are written under a temporary name first, so that a reader never sees a partial cache.
+    :param compact: store [1, 28, 28] uint8 images, 12 times smaller than the normalised float ones
+    :param workers: processes decoding the images, all cores by default
+    :param archive: datasets.omniglot_zip.ZipFolder to read the images from instead of the extracted folder
+    """
+    target_folder = join(root, folder)
+    # Taken before the scan, a change during the build then only causes another incremental build
+    stamp = tree_stamp(root, folder, archive)
+    if archive is None:
+        characters, rows = scan(target_folder)
+    else:
+        characters, rows = archive.scan(folder)
+
+    images_path, index_path = cache_paths(root, folder, compact)
+    makedir_exist_ok(os.path.dirname(images_path))
+    previous = load_manifest(root, folder, compact)
+    old_images = np.load(images_path, mmap_mode='r') if previous else None
+
+    dtype, shape = (np.uint8, (1, 28, 28)) if compact else (np.float32, (3, 28, 28))
+    # Temporary names are per process, several jobs may build the same missing cache at once
+    images_tmp, index_tmp = ['%s.%d.tmp' % (path, os.getpid()) for path in (images_path, index_path)]
+    images = np.lib.format.open_memmap(images_tmp, mode='w+', dtype=dtype, shape=(len(rows),) + shape)
+    hashes = [None] * len(rows)
+    todo = []
+    for row, (idx, f, mtime, size) in enumerate(rows):
+        old = previous.get((characters[idx], f))
+        if old is not None and old[1:3] == (mtime, size):
+            images[row] = old_images[old[0]]
+            hashes[row] = old[3]
+        else:
+            todo.append(row)
+
+    decoded = 0
+    if todo:
+        keys = [(characters[rows[row][0]], rows[row][1]) for row in todo]
+        if archive is None:
+            sources = [join(target_folder, character, f) for character, f in keys]
+        else:
+            sources = [archive.read(join(folder, character, f)) for character, f in keys]
+        known = [previous[key][3] if key in previous else None for key in keys]
+        with ProcessPoolExecutor(workers) as pool:
+            results = pool.map(_preprocess, sources, repeat(compact), known, chunksize=64)
+            for row, key, (digest, image) in zip(todo, keys, results):
+                hashes[row] = digest
+                if image is None:
+                    images[row] = old_images[previous[key][0]]
+                else:
+                    images[row] = image
+                    decoded += 1
+    images.flush()
+    del images, old_images
+
+    with open(index_tmp, 'wb') as f:
+        np.savez(f, version=CACHE_VERSION, stamp=stamp, characters=np.array(characters),
+                 character=np.array([row[0] for row in rows], dtype=np.int64),
+                 files=np.array([row[1] for row in rows]),
+                 mtime=np.array([row[2] for row in rows], dtype=np.int64),
+                 size=np.array([row[3] for row in rows], dtype=np.int64),
+                 hash=np.array(hashes))
+    os.replace(images_tmp, images_path)
+    os.replace(index_tmp, index_path)
+    logger.info("Cached %d images of %s in %s, %d of them decoded", len(rows), folder, images_path, decoded)
+
+
+class OmniglotCache:
+    """
+    Preprocessed images of one Omniglot folder, memory-mapped from the file written by build_cache. The pages are
+    shared by every process and DataLoader worker reading the same file, and nothing is decoded.
+    """
+
+    def __init__(self, root, folder, compact=False):
+        self.images_path, index_path = cache_paths(root, folder, compact)
+        index = np.load(index_path)
+        if int(index['version']) != CACHE_VERSION:
+            raise RuntimeError('Omniglot cache %s has version %d, expected %d' %
+                               (index_path, int(index['version']), CACHE_VERSION))
+        characters = index['characters'].tolist()
+        self.rows = {(characters[idx], f): row for row, (idx, f) in
+                     enumerate(zip(index['character'].tolist(), index['files'].tolist()))}
+        # tree_stamp of the images the cache was built from, empty for caches written before it was recorded
+        self.stamp = str(index['stamp']) if 'stamp' in index else ''
+        self._images = None
+
+    @staticmethod
+    def exists(root, folder, compact=False):
+        return all(os.path.isfile(p) for p in cache_paths(root, folder, compact))
+
+    @property
+    def images(self):
+        # Opened lazily, so that every worker maps the file itself instead of receiving a pickled copy
+        if self._images is None:
+            self._images = np.load(self.images_path, mmap_mode='r')
+        return self._images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    def __len__(self):
+        return len(self.rows)
+
+    def covers(self, characters, data, targets):
+        """
+        :param characters: character directories of a split, data and targets its file names and classes
+        :return: whether every image of the split is in the cache
+        """
+        return all((characters[t], f) in self.rows for f, t in zip(data.tolist(), targets.tolist()))
+
+    def get(self, character, image_name):
+        """
+        :param character: alphabet/character directory of the image
+        :return: [3, 28, 28] float tensor, or [1, 28, 28] uint8 tensor for a compact cache
+        """
+        return torch.from_numpy(np.array(self.images[self.rows[(character, image_name)]]))
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Preprocess the Omniglot images into a memory-mapped cache')
+    argparser.add_argument('--root', help='directory holding omniglot-py', default="../data/omni")
+    argparser.add_argument('--compact', action='store_true', help='build the uint8 single channel cache')
+    argparser.add_argument('--zip', action='store_true', help='read the images from the zip files, not extracted')
+    argparser.add_argument('--workers', type=int, help='decoding processes, all cores by default', default=None)
+    args = argparser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    root = join(os.path.expanduser(args.root), 'omniglot-py')
+    for folder in ['images_background', 'images_evaluation']:
+        archive = ZipFolder(join(root, folder + '.zip')) if args.zip else None
+        build_cache(root, folder, args.compact, args.workers, archive)
@@ -0,0 +1,82 @@
+import io
+import os
+import time
+import zipfile
+from os.path import join
+
+
+def _member(path):
+    return path.replace(os.sep, '/').strip('/')
+
+
+class ZipFolder:
+    """
+    Omniglot images read straight from the downloaded zip, without extracting it. The central directory is indexed
+    once, and every process (e.g. every DataLoader worker) opens its own handle of the archive on its first read.
+    Threads of one process share the handle, ZipFile serialises their reads.
+    """
+
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        self.members = {}
+        # Directory of the archive to its entries, True for the subdirectories. Entries keep the archive order.
+        self.children = {}
+        with zipfile.ZipFile(zip_path) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                self.members[info.filename] = info
+                parts = info.filename.split('/')
+                for depth in range(len(parts)):
+                    self.children.setdefault('/'.join(parts[:depth]), {})[parts[depth]] = depth < len(parts) - 1
+        self._archive = None
+        self._pid = None
+
+    @property
+    def archive(self):
+        # Forked DataLoader workers inherit the handle of the parent, whose file offset is shared with the
+        # threads still reading in the parent; each process therefore opens the archive again
+        if self._archive is None or self._pid != os.getpid():
+            self._archive = zipfile.ZipFile(self.zip_path)
+            self._pid = os.getpid()
+        return self._archive
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_archive'] = None
+        state['_pid'] = None
+        return state
+
+    def list_dir(self, path):
+        """
+        :param path: directory inside the archive, e.g. images_background/Latin
+        :return: names of its subdirectories
+        """
+        return [name for name, is_dir in self.children.get(_member(path), {}).items() if is_dir]
+
+    def list_files(self, path, suffix):
+        return [name for name, is_dir in self.children.get(_member(path), {}).items()
+                if not is_dir and name.endswith(suffix)]
+
+    def read(self, path):
+        """
+        :return: content of the file at path inside the archive
+        """
+        return self.archive.read(self.members[_member(path)])
+
+    def open(self, path):
+        return io.BytesIO(self.read(path))
+
+    def scan(self, folder):
+        """
+        Same as datasets.omniglot_cache.scan for the folder inside the archive, with the modification times and
+        sizes of the central directory.
+        """
+        characters = sorted(join(a, c) for a in self.list_dir(folder) for c in self.list_dir(join(folder, a)))
+        rows = []
+        for idx, character in enumerate(characters):
+            for f in sorted(self.list_files(join(folder, character), '.png')):
+                info = self.members[_member(join(folder, character, f))]
+                mtime = int(time.mktime(info.date_time + (0, 0, -1))) * 10 ** 9
+                rows.append((idx, f, mtime, info.file_size))
+        return characters, rows
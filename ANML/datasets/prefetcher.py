@@ -0,0 +1,69 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger("experiment")
+
+
+class EpisodePrefetcher:
+    """
+    Builds the episodes of the coming meta steps on a background thread while the current meta step runs. At most
+    `depth` episodes are kept ready in a bounded queue.
+    """
+
+    def __init__(self, sample, steps, depth=2, pin_memory=False):
+        """
+        :param sample: function of the step index returning the episode, a tuple of tensors
+        :param steps: number of episodes to build
+        :param depth: number of episodes built ahead
+        :param pin_memory: pin the episode tensors so that they can be copied to the GPU asynchronously
+        """
+        self.steps = steps
+        self.queue = queue.Queue(maxsize=depth)
+        # Consumer side statistics, see starvation
+        self.episodes = 0
+        self.starved = 0
+        self.wait = 0.
+
+        self.thread = threading.Thread(target=self._produce, args=(sample, pin_memory), daemon=True)
+        self.thread.start()
+
+    def _produce(self, sample, pin_memory):
+        try:
+            for step in range(self.steps):
+                episode = sample(step)
+                if pin_memory:
+                    episode = tuple(t.pin_memory() for t in episode)
+                self.queue.put(episode)
+        except Exception as e:
+            # Raised again on the consumer side
+            self.queue.put(e)
+
+    def get(self):
+        start = time.time()
+        if self.queue.empty():
+            self.starved += 1
+        episode = self.queue.get()
+        self.wait += time.time() - start
+        self.episodes += 1
+
+        if isinstance(episode, Exception):
+            raise episode
+        return episode
+
+    def __iter__(self):
+        for _ in range(self.steps):
+            yield self.get()
+
+    def __len__(self):
+        return self.steps
+
+    def starvation(self):
+        """
+        :return: fraction of the episodes the training loop had to wait for, mean wait per episode in seconds.
+        A fraction close to one means that data loading is the bottleneck, close to zero that compute is.
+        """
+        if self.episodes == 0:
+            return 0., 0.
+        return self.starved / self.episodes, self.wait / self.episodes
@@ -1,9 +1,13 @@
 import copy
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 
+from .omniglot_cache import collate
+
 logger = logging.getLogger("experiment")
 
 
@@ -227,40 +231,95 @@ class OmniglotSampler:
         dataset = self.task_sampler.get_task_trainset(t, train)
         train_iterator = torch.utils.data.DataLoader(dataset,
                                                      batch_size=1,
-                                                     shuffle=True, num_workers=1)
+                                                     shuffle=True, num_workers=1, collate_fn=collate)
         return train_iterator
 
 
+class SampleService:
+    """
+    One pool of worker threads shared by every per-class sample stream of SampleOmni, instead of a DataLoader with
+    its own worker process (and image cache) per class. Process count and memory stay the same however many
+    classes have been visited.
+    """
+
+    def __init__(self, workers=4):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def stream(self, dataset, indices, batch_size=1, shuffle=True):
+        return ClassStream(self, dataset, indices, batch_size, shuffle)
+
+
+class ClassStream:
+    """
+    Iterable over batches of the given images of a dataset, collated like a DataLoader and reshuffled every time it
+    is iterated. The images are loaded on the pool of a SampleService, a few batches ahead of the consumer.
+    """
+
+    def __init__(self, service, dataset, indices, batch_size=1, shuffle=True, ahead=2):
+        self.service = service
+        self.dataset = dataset
+        self.indices = np.asarray(indices)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.ahead = ahead
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        order = self.indices
+        if self.shuffle:
+            order = order[torch.randperm(len(order)).numpy()]
+
+        window = (self.ahead + 1) * self.batch_size
+        pending = deque()
+        next_item = 0
+        try:
+            while next_item < len(order) or pending:
+                while next_item < len(order) and len(pending) < window:
+                    pending.append(self.service.pool.submit(self.dataset.__getitem__, int(order[next_item])))
+                    next_item += 1
+                batch = [pending.popleft().result() for _ in range(min(self.batch_size, len(pending)))]
+                yield collate(batch)
+        finally:
+            # The consumer usually stops after a few batches
+            for future in pending:
+                future.cancel()
+
+
 class SampleOmni:
 
-    def __init__(self, trainset, testset):
+    def __init__(self, trainset, testset, workers=4):
         self.task_iterators = []
         self.trainset = trainset
         self.testset = testset
+        self.service = SampleService(workers)
         self.iterators = {}
         self.test_iterators = {}
+        # train -> class index, see class_index
+        self.class_indices = {}
 
     def add_complete_iteraetor(self, tasks):
         dataset = self.get_task_trainset(tasks, True)
         # dataset = self.get_task_testset(tasks)
         train_iterator = torch.utils.data.DataLoader(dataset,
                                                      batch_size=64,
-                                                     shuffle=True, num_workers=1)
+                                                     shuffle=True, num_workers=1, collate_fn=collate)
         self.complete_iterator = train_iterator
         logger.info("Len of complete iterator = %d", len(self.complete_iterator) * 64)
 
         train_iterator2 = torch.utils.data.DataLoader(dataset,
                                                       batch_size=1,
-                                                      shuffle=True, num_workers=1)
+                                                      shuffle=True, num_workers=1, collate_fn=collate)
 
         self.another_complete_iterator = train_iterator2
 
     def add_task_iterator(self, task, train):
-        dataset = self.get_task_trainset([task], train)
+        dataset = self.trainset if train else self.testset
+        indices = self.class_index(train).get(task, [])
 
-        train_iterator = torch.utils.data.DataLoader(dataset,
-                                                     batch_size=1,
-                                                     shuffle=True, num_workers=1)
+        # A stream only holds the indices of the class, its images are loaded by the shared service
+        train_iterator = self.service.stream(dataset, indices, batch_size=1, shuffle=True)
         self.iterators[task] = train_iterator
         #print("Class %d has been added to the list" % task)
         return train_iterator
@@ -279,40 +338,33 @@ class SampleOmni:
                 else:
                     return self.add_task_iterator(task, False)
 
-    def get_task_trainset(self, task, train):
-
-        if train:
-            trainset = copy.deepcopy(self.trainset)
-        else:
-            trainset = copy.deepcopy(self.testset)
-        class_labels = np.array([x[1] for x in trainset._flat_character_images])
-
-        indices = np.zeros_like(class_labels)
-        for a in task:
-            indices = indices + (class_labels == a).astype(int)
-        indices = np.nonzero(indices)
-
-        trainset._flat_character_images = [trainset._flat_character_images[i] for i in indices[0]]
-        trainset.data = [trainset.data[i] for i in indices[0]]
-        trainset.targets = [trainset.targets[i] for i in indices[0]]
+    def class_index(self, train):
+        """
+        Inverted index of the train or test set, built once: class -> indices of its images in the dataset.
+        """
+        index = self.class_indices.get(train)
+        if index is None:
+            targets = np.asarray((self.trainset if train else self.testset).targets)
+            order = np.argsort(targets, kind='stable')
+            classes, starts = np.unique(targets[order], return_index=True)
+            ends = np.append(starts[1:], len(order))
+            index = {c: order[s:e] for c, s, e in zip(classes.tolist(), starts, ends)}
+            self.class_indices[train] = index
+        return index
 
-        return trainset
+    def get_task_trainset(self, task, train):
+        """
+        :return: view of the train (or test) set restricted to the classes in task; it shares the images and the
+        image cache of the full dataset
+        """
+        dataset = self.trainset if train else self.testset
+        index = self.class_index(train)
+        empty = np.zeros(0, dtype=np.int64)
+        indices = np.sort(np.concatenate([index.get(a, empty) for a in task]))
+        return torch.utils.data.Subset(dataset, indices.tolist())
 
     def get_task_testset(self, task):
-
-        trainset = copy.deepcopy(self.testset)
-        class_labels = np.array([x[1] for x in trainset._flat_character_images])
-
-        indices = np.zeros_like(class_labels)
-        for a in task:
-            indices = indices + (class_labels == a).astype(int)
-        indices = np.nonzero(indices)
-
-        trainset._flat_character_images = [trainset._flat_character_images[i] for i in indices[0]]
-        trainset.data = [trainset.data[i] for i in indices[0]]
-        trainset.targets = [trainset.targets[i] for i in indices[0]]
-
-        return trainset
+        return self.get_task_trainset(task, False)
 
     def filter_upto(self, task):
 
@@ -320,3 +372,69 @@ class SampleOmni:
         trainset.data = trainset.data[trainset.data['target'] <= task]
 
         return trainset
+
+
+class EpisodeSampler:
+    """
+    Samples the episodes of MetaLearingClassification.sample_training_data from one tensor holding the whole dataset,
+    grouped by class, with a few index gathers instead of iterating DataLoaders image by image.
+    """
+
+    def __init__(self, dataset, seed=None, batch_size=256):
+        """
+        :param dataset: Omniglot split, decoded once
+        :param seed: seed of the generator the episodes are drawn with
+        """
+        # Compact images stay uint8 here and in the episodes, the training loop expands them on the device
+        iterator = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=1)
+        images = []
+        targets = []
+        for img, target, *_ in iterator:
+            images.append(img)
+            targets.append(target.long())
+        images = torch.cat(images)
+        targets = torch.cat(targets)
+
+        order = torch.argsort(targets)
+        self.images = images[order].contiguous()
+        self.targets = targets[order]
+        # The images of class c are images[offsets[c]:offsets[c] + counts[c]]
+        self.counts = torch.bincount(self.targets)
+        self.offsets = torch.cumsum(self.counts, 0) - self.counts
+        # The complete iterator covers the classes range(max target) only, i.e. every image before the last class
+        self.complete = self.offsets[-1].item()
+
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        logger.info("Episode sampler holds %d images of %d classes", len(self.targets), len(self.counts))
+
+    def class_indices(self, c, n):
+        """
+        :return: indices of n distinct random images of class c, drawn with replacement if it has fewer
+        """
+        count = self.counts[c].item()
+        if count >= n:
+            indices = torch.randperm(count, generator=self.generator)[:n]
+        else:
+            indices = torch.randint(count, (n,), generator=self.generator)
+        return self.offsets[c] + indices
+
+    def sample(self, classes, steps, rand_batch=64):
+        """
+        Same episode as sample_training_data with one class iterator per entry of classes and a complete iterator
+        of batch size rand_batch.
+        :return: x_traj [steps, 1, ...], y_traj [steps, 1], x_rand [1, rand_batch + steps, ...],
+        y_rand [1, rand_batch + steps]
+        """
+        per_class = [steps // len(classes)] * len(classes)
+        per_class[-1] += steps - sum(per_class)
+
+        traj = torch.cat([self.class_indices(c, n) for c, n in zip(classes, per_class)])
+        # A second pass over the classes of the trajectory joins the random batch
+        again = torch.cat([self.class_indices(c, n) for c, n in zip(classes, per_class)])
+        rand = torch.randperm(self.complete, generator=self.generator)[:rand_batch]
+        query = torch.cat([rand, again])
+
+        return (self.images[traj].unsqueeze(1), self.targets[traj].unsqueeze(1),
+                self.images[query].unsqueeze(0), self.targets[query].unsqueeze(0))
@@ -1,5 +1,6 @@
 import errno
 import hashlib
+import json
 import os
 import os.path
 
@@ -34,6 +35,38 @@ def check_integrity(fpath, md5=None):
     return True
 
 
+def check_integrity_stamped(fpath, md5=None, deep=False):
+    """
+    check_integrity, remembered in a stamp file next to fpath. The file is hashed again only if its size, mtime or
+    inode differ from the stamp of the last successful check, or if deep is set.
+    :param deep: hash the file even if the stamp matches
+    """
+    if md5 is None:
+        return True
+    if not os.path.isfile(fpath):
+        return False
+    stat = os.stat(fpath)
+    stamp = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'inode': stat.st_ino, 'md5': md5}
+    stamp_path = fpath + '.verified'
+    if not deep and os.path.isfile(stamp_path):
+        try:
+            with open(stamp_path) as f:
+                if json.load(f) == stamp:
+                    return True
+        except ValueError:
+            pass
+
+    if not check_integrity(fpath, md5):
+        return False
+    try:
+        with open(stamp_path, 'w') as f:
+            json.dump(stamp, f)
+    except OSError:
+        # e.g. a read-only dataset directory, the file is then hashed on every check
+        pass
+    return True
+
+
 def makedir_exist_ok(dirpath):
     """
     Python2 support for os.makedirs(.., exist_ok=True)
@@ -93,12 +126,9 @@ def list_dir(root, prefix=False):
             only returns the name of the directories found
     """
     root = os.path.expanduser(root)
-    directories = list(
-        filter(
-            lambda p: os.path.isdir(os.path.join(root, p)),
-            os.listdir(root)
-        )
-    )
+    # scandir gets the entry types from the directory listing, without a stat call per entry on most filesystems
+    with os.scandir(root) as entries:
+        directories = [e.name for e in entries if e.is_dir()]
 
     if prefix is True:
         directories = [os.path.join(root, d) for d in directories]
@@ -116,12 +146,8 @@ def list_files(root, suffix, prefix=False):
             only returns the name of the files found
     """
     root = os.path.expanduser(root)
-    files = list(
-        filter(
-            lambda p: os.path.isfile(os.path.join(root, p)) and p.endswith(suffix),
-            os.listdir(root)
-        )
-    )
+    with os.scandir(root) as entries:
+        files = [e.name for e in entries if e.name.endswith(suffix) and e.is_file()]
 
     if prefix is True:
         files = [os.path.join(root, d) for d in files]
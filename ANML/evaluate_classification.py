@@ -12,6 +12,8 @@ from torch.nn import functional as F
 import datasets.datasetfactory as df
 import model.learner as learner
 import model.modelfactory as mf
+import model.quantized_learner as ql
+from datasets.omniglot_cache import collate, expand
 import utils
 from experiment.experiment import experiment
 
@@ -42,28 +44,43 @@ def main(args):
     #for v in range(6):
     #    frozen_layers.append("vars_bn.{0}".format(v))
 
+    # Frozen-layer activations are computed once and reused by every fine-tuning run
+    use_cache = args.feature_cache and args.dataset == "omniglot" and args.rln > 0 and not (args.scratch or args.no_freeze)
+
+    if args.quantize:
+        # Background images the int8 activation ranges are calibrated on
+        calibration = ql.calibration_set(
+            df.DatasetFactory.get_dataset("omniglot", ksplit=args.ksplit, train=True, background=True,
+                                          path=args.dataset_path, cache=args.dataset_cache,
+                                          compact=args.compact_images, deep_verify=args.deep_verify,
+                                          zip_storage=args.zip_storage),
+            args.calibration_size, args.seed)
+
     final_results_all = []
+    quantized_results_all = []
     temp_result = []
     total_clases = args.schedule
     for tot_class in total_clases:
         lr_list = [0.001, 0.0006, 0.0004, 0.00035, 0.0003, 0.00025, 0.0002, 0.00015, 0.0001, 0.00009, 0.00008, 0.00006, 0.00003, 0.00001]
         lr_all = []
+        train_cache = None
+        test_cache = None
         for lr_search in range(10):
 
             #keep = np.random.choice(list(range(650)), tot_class, replace=False)
             keep = list(range(tot_class))
 
-            dataset = utils.remove_classes_omni(
-                df.DatasetFactory.get_dataset("omniglot",ksplit=args.ksplit, train=True, background=False, path=args.dataset_path), keep)
+            dataset_sorted = utils.remove_classes_omni(
+                df.DatasetFactory.get_dataset("omniglot",ksplit=args.ksplit, cache=args.dataset_cache, compact=args.compact_images, deep_verify=args.deep_verify, zip_storage=args.zip_storage, train=True, background=False, path=args.dataset_path), keep)
             iterator_sorted = torch.utils.data.DataLoader(
-                utils.iterator_sorter_omni(dataset, False, classes=total_clases),
+                utils.iterator_sorter_omni(dataset_sorted, False, classes=total_clases),
                 batch_size=1,
-                shuffle=args.iid, num_workers=2)
+                shuffle=args.iid, num_workers=2, collate_fn=collate)
             dataset = utils.remove_classes_omni(
-                df.DatasetFactory.get_dataset("omniglot",ksplit=args.ksplit, train=not args.test, background=False, path=args.dataset_path),
+                df.DatasetFactory.get_dataset("omniglot",ksplit=args.ksplit, cache=args.dataset_cache, compact=args.compact_images, deep_verify=args.deep_verify, zip_storage=args.zip_storage, train=not args.test, background=False, path=args.dataset_path),
                 keep)
             iterator = torch.utils.data.DataLoader(dataset, batch_size=1,
-                                                   shuffle=False, num_workers=1)
+                                                   shuffle=False, num_workers=1, collate_fn=collate)
 
             print(args)
 
@@ -89,6 +106,9 @@ def main(args):
                         # maml = MetaLearingClassification(args, config).to(device).net
 
                     maml = maml.to(device)
+                    maml.batched = args.batched
+                    maml.fuse_stem = args.fuse_stem
+                    maml.gate_threshold = args.gate_threshold
 
                     for name, param in maml.named_parameters():
                         param.learn = True
@@ -156,9 +176,23 @@ def main(args):
                      #   logger.info("Unfrozen layer = %s", str(x[0]))
                     opt = torch.optim.Adam(list_of_params, lr=lr)
 
+                    if use_cache and train_cache is None:
+                        # The frozen layers are the same for every LR and search iteration
+                        train_cache = utils.FeatureCache(maml, dataset_sorted, args.rln, device)
+                        test_cache = utils.FeatureCache(maml, dataset, args.rln, device)
+
                     for _ in range(0, args.epoch):
+                        if use_cache:
+                            for state, y in train_cache.batches(shuffle=args.iid):
+                                pred = maml.forward_suffix(state, y//args.ksplit, args.rln)
+                                opt.zero_grad()
+                                loss = F.cross_entropy(pred, y)
+                                loss.backward()
+                                opt.step()
+                            continue
+
                         for img, y, charc, task in iterator_sorted:
-                            img = img.to(device)
+                            img = expand(img.to(device))
                             y = y.long().to(device)
 
                             pred = maml(img, y//args.ksplit)
@@ -169,12 +203,16 @@ def main(args):
 
                     logger.info("Result after one epoch for LR = %f", lr)
                     correct = 0
-                    for img, target, charc, task in iterator:
-                        img = img.to(device)
-                        target = target.to(device)
-                        logits_q = maml(img, target//args.ksplit, vars=None, bn_training=False, feature=False)
-                        pred_q = (logits_q).argmax(dim=1)
-                        correct += torch.eq(pred_q, target).sum().item() / len(img)
+                    net = maml.export() if args.fold_bn else maml
+                    if use_cache:
+                        correct = test_cache.accuracy(net, args.ksplit) * len(iterator)
+                    else:
+                        for img, target, charc, task in iterator:
+                            img = expand(img.to(device))
+                            target = target.to(device)
+                            logits_q = net(img, target//args.ksplit, vars=None, bn_training=False, feature=False)
+                            pred_q = (logits_q).argmax(dim=1)
+                            correct += torch.eq(pred_q, target).sum().item() / len(img)
 
                     logger.info(str(correct / len(iterator)))
                     if (correct / len(iterator) > max_acc):
@@ -197,6 +235,8 @@ def main(args):
         best_lr = float(stats.mode(lr_all)[0][0])
         logger.info("BEST LR %s= ", str(best_lr))
 
+        train_cache = None
+        test_cache = None
         for aoo in range(args.runs):
 
             #keep = np.random.choice(list(range(650)), tot_class, replace=False)
@@ -204,16 +244,16 @@ def main(args):
 
             if args.dataset == "omniglot":
 
-                dataset = utils.remove_classes_omni(
-                    df.DatasetFactory.get_dataset("omniglot",ksplit=args.ksplit, train=True, background=False), keep)
+                dataset_sorted = utils.remove_classes_omni(
+                    df.DatasetFactory.get_dataset("omniglot",ksplit=args.ksplit, cache=args.dataset_cache, compact=args.compact_images, deep_verify=args.deep_verify, zip_storage=args.zip_storage, train=True, background=False), keep)
                 iterator_sorted = torch.utils.data.DataLoader(
-                    utils.iterator_sorter_omni(dataset, False, classes=total_clases),
+                    utils.iterator_sorter_omni(dataset_sorted, False, classes=total_clases),
                     batch_size=1,
-                    shuffle=args.iid, num_workers=2)
+                    shuffle=args.iid, num_workers=2, collate_fn=collate)
                 dataset = utils.remove_classes_omni(
-                    df.DatasetFactory.get_dataset("omniglot",ksplit=args.ksplit, train=not args.test, background=False), keep)
+                    df.DatasetFactory.get_dataset("omniglot",ksplit=args.ksplit, cache=args.dataset_cache, compact=args.compact_images, deep_verify=args.deep_verify, zip_storage=args.zip_storage, train=not args.test, background=False), keep)
                 iterator = torch.utils.data.DataLoader(dataset, batch_size=1,
-                                                       shuffle=False, num_workers=1)
+                                                       shuffle=False, num_workers=1, collate_fn=collate)
             elif args.dataset == "CIFAR100":
                 keep = np.random.choice(list(range(50, 100)), tot_class)
                 dataset = utils.remove_classes(df.DatasetFactory.get_dataset(args.dataset, train=True), keep)
@@ -247,6 +287,9 @@ def main(args):
                     maml = learner.Learner(config, args.ksplit)
 
                 maml = maml.to(device)
+                maml.batched = args.batched
+                maml.fuse_stem = args.fuse_stem
+                maml.gate_threshold = args.gate_threshold
 
                 for name, param in maml.named_parameters():
                     param.learn = True
@@ -296,14 +339,23 @@ def main(args):
                             w = nn.Parameter(torch.zeros_like(a)).to(device)
                             a.data = w
                 
+                if use_cache and train_cache is None:
+                    # fp32 activations, the int8 accuracy below is measured end to end on the quantized model
+                    train_cache = utils.FeatureCache(maml, dataset_sorted, args.rln, device)
+                    test_cache = utils.FeatureCache(maml, dataset, args.rln, device)
+
                 correct = 0
-                for img, target, charc, task in iterator:
-                    with torch.no_grad():
-                        img = img.to(device)
-                        target = target.long().to(device)
-                        logits_q = maml(img, target//args.ksplit, vars=None, bn_training=False, feature=False)
-                        pred_q = (logits_q).argmax(dim=1)
-                        correct += torch.eq(pred_q, target).sum().item() / len(img)
+                net = maml.export() if args.fold_bn else maml
+                if use_cache:
+                    correct = test_cache.accuracy(net, args.ksplit) * len(iterator)
+                else:
+                    for img, target, charc, task in iterator:
+                        with torch.no_grad():
+                            img = expand(img.to(device))
+                            target = target.long().to(device)
+                            logits_q = net(img, target//args.ksplit, vars=None, bn_training=False, feature=False)
+                            pred_q = (logits_q).argmax(dim=1)
+                            correct += torch.eq(pred_q, target).sum().item() / len(img)
 
 
                 logger.info("Pre-epoch accuracy %s", str(correct / len(iterator)))
@@ -326,8 +378,17 @@ def main(args):
                 opt = torch.optim.Adam(list_of_params, lr=lr)
 
                 for _ in range(0, args.epoch):
+                    if use_cache:
+                        for state, y in train_cache.batches(shuffle=args.iid):
+                            pred = maml.forward_suffix(state, y//args.ksplit, args.rln)
+                            opt.zero_grad()
+                            loss = F.cross_entropy(pred, y)
+                            loss.backward()
+                            opt.step()
+                        continue
+
                     for img, y, charc, task in iterator_sorted:
-                        img = img.to(device)
+                        img = expand(img.to(device))
                         y = y.long().to(device)
                         pred = maml(img, y//args.ksplit)
                         opt.zero_grad()
@@ -338,16 +399,41 @@ def main(args):
                 logger.info("Result after one epoch for LR = %f", lr)
                 
                 correct = 0
-                for img, target, charc, task in iterator:
-                    img = img.to(device)
-                    target = target.long().to(device)
-                    logits_q = maml(img, target//args.ksplit, vars=None, bn_training=False, feature=False)
+                net = maml.export() if args.fold_bn else maml
+                if use_cache:
+                    correct = test_cache.accuracy(net, args.ksplit) * len(iterator)
+                else:
+                    gate_sparsity = []
+                    for img, target, charc, task in iterator:
+                        img = expand(img.to(device))
+                        target = target.long().to(device)
+                        logits_q = net(img, target//args.ksplit, vars=None, bn_training=False, feature=False)
+
+                        pred_q = (logits_q).argmax(dim=1)
 
-                    pred_q = (logits_q).argmax(dim=1)
+                        correct += torch.eq(pred_q, target).sum().item() / len(img)
+                        if args.gate_threshold is not None:
+                            gate_sparsity.append((net.gate_sparsity, net.column_sparsity))
 
-                    correct += torch.eq(pred_q, target).sum().item() / len(img)
+                    if gate_sparsity:
+                        logger.info("Gate sparsity = %s, skipped fc columns = %s", *map(str, np.mean(gate_sparsity, axis=0)))
 
                 logger.info(str(correct / len(iterator)))
+
+                if args.quantize:
+                    qnet = ql.quantize(maml, calibration, transform=expand)
+                    q_correct = 0
+                    with torch.no_grad():
+                        for img, target, charc, task in iterator:
+                            img = expand(img.to(device))
+                            target = target.long().to(device)
+                            pred_q = qnet(img, target//args.ksplit).argmax(dim=1)
+                            q_correct += torch.eq(pred_q, target).sum().item() / len(img)
+                    q_acc = q_correct / len(iterator)
+                    logger.info("Int8 accuracy = %s, delta to fp32 = %s", str(q_acc), str(q_acc - correct / len(iterator)))
+                    quantized_results_all.append((tot_class, correct / len(iterator), q_acc))
+                    writer.add_scalar('/finetune/int8_' + str(aoo), q_acc, tot_class)
+
                 if (correct / len(iterator) > max_acc):
                     max_acc = correct / len(iterator)
                     max_lr = lr
@@ -361,6 +447,9 @@ def main(args):
             logger.info("Final results = %s", str(results_mem_size))
 
             my_experiment.results["Final Results"] = final_results_all
+            if args.quantize:
+                # (classes, fp32 accuracy, int8 accuracy) of every run
+                my_experiment.results["Quantized Results"] = quantized_results_all
             my_experiment.store_json()
             print("FINAL RESULTS = ", final_results_all)
 
@@ -387,7 +476,25 @@ if __name__ == '__main__':
     argparser.add_argument("--rln", type=int, default=6)
     argparser.add_argument("--runs", type=int, default=50)
     argparser.add_argument("--neuromodulation", action="store_true")
+    argparser.add_argument("--batched", action="store_true", help='run the neuromodulated network on whole batches')
+    argparser.add_argument("--fuse_stem", action="store_true", help='fuse the first conv of the NM and prediction networks')
     argparser.add_argument('--ksplit', type=int, help='number of char per alphabet', default=5)
+    argparser.add_argument("--feature_cache", action="store_true", help='compute the frozen layers once per image')
+    argparser.add_argument("--fold_bn", action="store_true", help='evaluate accuracy with batch norms folded, see Learner.export')
+    argparser.add_argument('--gate_threshold', type=float, default=None,
+                           help='skip the fc inputs whose neuromodulatory gate is below this value')
+    argparser.add_argument("--dataset_cache", action="store_true",
+                           help='read Omniglot from the preprocessed memory-mapped cache, built on first use')
+    argparser.add_argument("--zip_storage", action="store_true",
+                           help='read Omniglot straight from the zip files instead of extracting them')
+    argparser.add_argument("--deep_verify", action="store_true",
+                           help='hash the Omniglot zip files again even if they were verified before')
+    argparser.add_argument("--compact_images", action="store_true",
+                           help='keep Omniglot images as uint8 single channel arrays, see datasets.omniglot_cache')
+    argparser.add_argument("--quantize", action="store_true",
+                           help='also evaluate an int8 copy of the model, see model.quantized_learner')
+    argparser.add_argument('--calibration_size', type=int, default=512,
+                           help='number of background images the int8 activation ranges are calibrated on')
 
 
     args = argparser.parse_args()
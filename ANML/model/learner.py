@@ -1,4 +1,8 @@
+import copy
 import logging
+from collections import namedtuple
+from functools import partial
+
 import matplotlib.pyplot as plt
 
 import numpy as np
@@ -18,6 +22,22 @@ def batchnorm(input, weight=None, bias=None, running_mean=None, running_var=None
     return F.batch_norm(input, running_mean, running_var, weight, bias, training, momentum, eps)
 
 
+def instancenorm(input, weight=None, bias=None, running_mean=None, running_var=None, eps=1e-5, momentum=0.1):
+    ''' Normalises every sample on its own; identical to F.batch_norm with training=True on a batch of one '''
+    return F.instance_norm(input, running_mean, running_var, weight, bias, True, momentum, eps)
+
+
+def gated_linear(input, gate, closed, weight, bias=None):
+    '''
+    F.linear(input * gate, weight, bias) with the closed gates set to zero. Only the columns of weight whose gate
+    is open for at least one sample of the batch are multiplied.
+    :return: output and number of columns used
+    '''
+    columns = (~closed).any(dim=0).nonzero().squeeze(1)
+    input = (input * gate.masked_fill(closed, 0)).index_select(1, columns)
+    return F.linear(input, weight.index_select(1, columns), bias), columns.numel()
+
+
 def maxpool(input, kernel_size, stride=None):
     return F.max_pool2d(input, kernel_size, stride)
 
@@ -26,18 +46,144 @@ def conv2d(input, weight, bias=None, stride=1, padding=0, dilation=1, groups=1):
     return F.conv2d(input, weight, bias, stride, padding, dilation, groups)
 
 
+def _input_weight(w, x):
+    # Single channel images stand for three identical channels (see datasets.omniglot_cache.expand); convolving
+    # them with the weights summed over the input channels gives the same result without copying them
+    if x.size(1) == 1 and w.size(1) > 1:
+        return w.sum(dim=1, keepdim=True)
+    return w
+
+
+# Ops of a compiled execution plan. Layer settings and parameter slots are bound with functools.partial
+# when the plan is built, so every op is then called as op(x, vars, vars_bn, bn_training).
+
+def _conv2d_op(idx, stride, padding, x, vars, vars_bn, bn_training):
+    return F.conv2d(x, _input_weight(vars[idx], x), vars[idx + 1], stride=stride, padding=padding)
+
+
+def _conv2d_nobias_op(idx, stride, padding, x, vars, vars_bn, bn_training):
+    # For convolutions followed by a per-sample normalisation, which subtracts the bias again
+    return F.conv2d(x, _input_weight(vars[idx], x), None, stride=stride, padding=padding)
+
+
+def _convt2d_op(idx, stride, padding, x, vars, vars_bn, bn_training):
+    return F.conv_transpose2d(x, vars[idx], vars[idx + 1], stride=stride, padding=padding)
+
+
+def _linear_op(idx, x, vars, vars_bn, bn_training):
+    return F.linear(x, vars[idx], vars[idx + 1])
+
+
+def _bn_op(idx, bn_idx, x, vars, vars_bn, bn_training):
+    return F.batch_norm(x, vars_bn[bn_idx], vars_bn[bn_idx + 1], weight=vars[idx], bias=vars[idx + 1],
+                        training=bn_training)
+
+
+def _instancenorm_op(idx, bn_idx, x, vars, vars_bn, bn_training):
+    if not bn_training:
+        # The running statistics are never used for normalisation, only update them while training
+        return instancenorm(x, vars[idx], vars[idx + 1])
+    return instancenorm(x, vars[idx], vars[idx + 1], vars_bn[bn_idx], vars_bn[bn_idx + 1])
+
+
+def _fused_conv2d_op(nm_idx, idx, nm_channels, stride, padding, bias, x, vars, vars_bn, bn_training):
+    # One convolution for two layers reading the same input; concatenating the weights keeps the
+    # result differentiable with respect to both original entries of vars
+    w = torch.cat([vars[nm_idx], vars[idx]], dim=0)
+    b = torch.cat([vars[nm_idx + 1], vars[idx + 1]], dim=0) if bias else None
+    x = F.conv2d(x, _input_weight(w, x), b, stride=stride, padding=padding)
+    return x[:, :nm_channels], x[:, nm_channels:]
+
+
+def _cat_op(ops, x, vars, vars_bn, bn_training):
+    # ops is a tuple of (collect, op); the outputs of the collected (linear) ops are concatenated
+    cat_list = []
+    for collect, op in ops:
+        x = op(x, vars, vars_bn, bn_training)
+        if collect:
+            cat_list.append(x)
+    return torch.cat(cat_list, dim=1)
+
+
+def _flatten_op(x, *_):
+    return x.view(x.size(0), -1)
+
+
+def _reshape_op(shape, x, *_):
+    return x.view(x.size(0), *shape)
+
+
+def _relu_op(inplace, x, *_):
+    return F.relu(x, inplace=inplace)
+
+
+def _leakyrelu_op(negative_slope, inplace, x, *_):
+    return F.leaky_relu(x, negative_slope=negative_slope, inplace=inplace)
+
+
+def _tanh_op(x, *_):
+    return torch.tanh(x)
+
+
+def _sigmoid_op(x, *_):
+    return torch.sigmoid(x)
+
+
+def _upsample_op(scale_factor, x, *_):
+    return F.upsample_nearest(x, scale_factor=scale_factor)
+
+
+def _max_pool2d_op(kernel_size, stride, padding, x, *_):
+    return F.max_pool2d(x, kernel_size, stride, padding)
+
+
+def _avg_pool2d_op(kernel_size, stride, padding, x, *_):
+    return F.avg_pool2d(x, kernel_size, stride, padding)
+
+
+# nm: ops of the neuromodulatory network producing the gate (None without neuromodulation)
+# trunk: ops up to the representation ('rep')
+# head: ops from the representation to the output
+# stem: (op, plan) when the first convolutions of both networks can be fused into op, with plan
+#       running the remaining ops; None otherwise
+# layers: (nm, trunk) index of the layer in vars (weight and bias pair) every op belongs to
+# fc: index in vars of the weight of the gated fc layer (None without neuromodulation)
+Plan = namedtuple('Plan', ['nm', 'trunk', 'head', 'stem', 'layers', 'fc'])
+
+
+def _run(ops, x, vars, vars_bn, bn_training):
+    for op in ops:
+        x = op(x, vars, vars_bn, bn_training)
+    return x
+
+
 class Learner(nn.Module):
 
-    def __init__(self, config, ksplit: int, neuromodulation=True):
+    def __init__(self, config, ksplit: int, neuromodulation=True, batched=False, fuse_stem=False,
+                 gate_threshold=None):
         """
         :param config: network config file, type:list of (string, list)
         :param imgc: 1 or 3
         :param imgsz:  28 or 84
+        :param batched: run the neuromodulation network on the whole mini-batch at once instead of image by image
+        :param fuse_stem: run the first convolutions of the neuromodulatory and prediction networks as one
+        :param gate_threshold: drop the representation units whose neuromodulatory gate is below this value and
+        only run the fc layer on the remaining ones; the fraction of closed gates of the last batch is kept in
+        gate_sparsity and the fraction of skipped fc columns in column_sparsity
         """
         super(Learner, self).__init__()
 
         self.config = config
         self.Neuromodulation = neuromodulation
+        self.batched = batched
+        self.fuse_stem = fuse_stem
+        self.gate_threshold = gate_threshold
+        # Set on the copies returned by export
+        self.folded = False
+        self.gate_sparsity = None
+        self.column_sparsity = None
+        # Closed gates of the last pass through _run_suffix, see _record_gates
+        self._closed = None
         # this dict contains all tensors needed to be optimized
         self.vars = nn.ParameterList()
         # running_mean and running_var
@@ -106,6 +252,55 @@ class Learner(nn.Module):
             else:
                 raise NotImplementedError
 
+        # One row per task, gathered by the tasks tensor to mask out classes outside each task's window
+        self.register_buffer('task_masks', self._build_task_masks())
+
+        self._plan = self._compile()
+        self._splits = {}
+        self._compiled = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # The plan holds bound ops and possibly compiled code; it is rebuilt from the config on load
+        del state['_plan']
+        del state['_splits']
+        del state['_compiled']
+        state['_closed'] = None
+        return state
+
+    def __setstate__(self, state):
+        super(Learner, self).__setstate__(state)
+        # Models pickled before these options existed
+        self.__dict__.setdefault('batched', False)
+        self.__dict__.setdefault('fuse_stem', False)
+        self.__dict__.setdefault('gate_threshold', None)
+        self.__dict__.setdefault('folded', False)
+        self.__dict__.setdefault('gate_sparsity', None)
+        self.__dict__.setdefault('column_sparsity', None)
+        self.__dict__.setdefault('_closed', None)
+        if 'task_masks' not in self._buffers:
+            task_masks = self._build_task_masks()
+            if task_masks is not None:
+                task_masks = task_masks.to(self.vars[0].device)
+            self.register_buffer('task_masks', task_masks)
+        self._plan = self._compile()
+        self._splits = {}
+        self._compiled = None
+
+    def _build_task_masks(self):
+        """
+        :return: [num_tasks, classes] mask bank with ones over the ksplit classes of each task, None if ksplit < 2
+        """
+        if self.ksplit < 2:
+            return None
+
+        classes = self.config[-1][1][0]
+        num_tasks = (classes + self.ksplit - 1) // self.ksplit
+        task_masks = torch.zeros(num_tasks, classes)
+        for task in range(num_tasks):
+            task_masks[task, task * self.ksplit: task * self.ksplit + self.ksplit] = 1
+        return task_masks
+
     def extra_repr(self):
         info = ''
 
@@ -154,203 +349,356 @@ class Learner(nn.Module):
 
         return info
 
-    def forward(self, x, tasks, vars=None, bn_training=True, feature=False):
+    def _compile(self):
         """
-        This function can be called by finetunning, however, in finetunning, we dont wish to update
-        running_mean/running_var. Thought weights/bias of bn is updated, it has been separated by fast_weights.
-        Indeed, to not update running_mean/running_var, we need set update_bn_statistics=False
-        but weight/bias will be updated and not dirty initial theta parameters via fast_weiths.
-        :param x: [b, 1, 28, 28]
-        :param vars:
-        :param bn_training: set False to not update
-        :return: x, loss, likelihood, kld
+        Resolves the config into an execution plan once, so forward neither walks the config nor tracks
+        parameter indices on every call.
+        :return: Plan
         """
+        if self.Neuromodulation:
+            return self._compile_neuromodulation()
 
-        cat_var = False
-        cat_list = []
-
-        if vars is None:
-            vars = self.vars
+        trunk = []
+        trunk_layers = []
+        head = []
+        ops = trunk
+        cat_ops = None
         idx = 0
         bn_idx = 0
+        folded = [fold[1] for fold in self._foldable_bn()] if self.folded else []
 
-        if self.Neuromodulation:
+        for name, param in self.config:
+            collect = False
+            if idx in folded and name == 'bn':
+                # Already folded into the weights of the previous layer
+                idx += 2
+                bn_idx += 2
+                continue
+            elif name == 'conv2d':
+                op = partial(_conv2d_op, idx, param[4], param[5])
+                idx += 2
+            elif name == 'convt2d':
+                op = partial(_convt2d_op, idx, param[4], param[5])
+                idx += 2
+            elif name == 'linear':
+                op = partial(_linear_op, idx)
+                collect = True
+                idx += 2
+            elif name == 'rep':
+                ops = head
+                continue
+            elif name == 'cat_start':
+                cat_ops = []
+                continue
+            elif name == 'cat':
+                op = partial(_cat_op, tuple(cat_ops))
+                cat_ops = None
+            elif name == 'bn':
+                op = partial(_bn_op, idx, bn_idx)
+                idx += 2
+                bn_idx += 2
+            elif name == 'flatten':
+                op = _flatten_op
+            elif name == 'reshape':
+                # [b, 8] => [b, 2, 2, 2]
+                op = partial(_reshape_op, tuple(param))
+            elif name == 'relu':
+                op = partial(_relu_op, param[0])
+            elif name == 'leakyrelu':
+                op = partial(_leakyrelu_op, param[0], param[1])
+            elif name == 'tanh':
+                op = _tanh_op
+            elif name == 'sigmoid':
+                op = _sigmoid_op
+            elif name == 'upsample':
+                op = partial(_upsample_op, param[0])
+            elif name == 'max_pool2d':
+                op = partial(_max_pool2d_op, param[0], param[1], param[2])
+            elif name == 'avg_pool2d':
+                op = partial(_avg_pool2d_op, param[0], param[1], param[2])
+            else:
+                raise NotImplementedError
 
-            # =========== NEUROMODULATORY NETWORK ===========
+            if cat_ops is not None:
+                cat_ops.append((collect, op))
+            else:
+                ops.append(op)
+                if ops is trunk:
+                    # Parameterless ops belong to the layer before them
+                    trunk_layers.append((idx - 1) // 2)
 
-            # 'conv1_nm'
-            # 'bn1_nm'
-            # 'conv2_nm'
-            # 'bn2_nm'
-            # 'conv3_nm'
-            # 'bn3_nm'
+        return Plan(None, tuple(trunk), tuple(head), None, (None, tuple(trunk_layers)), None)
 
-            # Query the neuromodulatory network:
+    def _compile_neuromodulation(self):
+        """
+        The Neuromodulation config only lists parametrised layers. Every batch norm is followed by a relu and a
+        2x2 max pool, except the last one of each network which is followed by a flatten. The gate is the
+        sigmoid of 'nm_to_fc' and 'fc' maps the gated representation to the classes.
+        :return: Plan
+        """
+        last_bn = {}
+        for name, param in self.config:
+            if 'bn' in name:
+                last_bn[name.endswith('_nm')] = name
+
+        # Every convolution feeds a per-sample normalisation
+        conv_op = _conv2d_nobias_op if self.folded else _conv2d_op
+
+        first_conv = {}
+        fc = None
+        nm = []
+        nm_layers = []
+        trunk = []
+        trunk_layers = []
+        head = []
+        idx = 0
+        bn_idx = 0
 
-            for i in range(x.size(0)):
+        for name, param in self.config:
+            if name.endswith('_nm') or 'nm_to' in name:
+                ops, op_layers = nm, nm_layers
+            elif name == 'fc':
+                ops, op_layers = head, []
+            else:
+                ops, op_layers = trunk, trunk_layers
 
-                data = x[i].view(1, 3, 28, 28)
-                nm_data = x[i].view(1, 3, 28, 28)
+            if 'conv' in name:
+                first_conv.setdefault(ops is nm, (idx, param))
+                new_ops = [partial(conv_op, idx, param[4], param[5])]
+            elif 'bn' in name:
+                new_ops = [partial(_instancenorm_op, idx, bn_idx), partial(_relu_op, False)]
+                if name in last_bn.values():
+                    new_ops.append(_flatten_op)
+                else:
+                    new_ops.append(partial(_max_pool2d_op, 2, 2, 0))
+                bn_idx += 2
+            elif 'nm_to' in name:
+                new_ops = [partial(_linear_op, idx), _sigmoid_op]
+            elif name == 'fc':
+                fc = idx
+                new_ops = [partial(_linear_op, idx)]
+            else:
+                raise NotImplementedError
 
-                # input_mask = self.call_input_nm(data_, vars)
-                # fc_mask = self.call_fc_nm(data_, vars)
+            ops.extend(new_ops)
+            op_layers.extend([idx // 2] * len(new_ops))
+            idx += 2
 
-                w, b = vars[0], vars[1]
-                nm_data = conv2d(nm_data, w, b)
-                w, b = vars[2], vars[3]
-                running_mean, running_var = self.vars_bn[0], self.vars_bn[1]
-                nm_data = F.batch_norm(nm_data, running_mean, running_var, weight=w, bias=b, training=True)
+        # conv1_nm and conv1 read the same input with the same geometry
+        stem = None
+        (nm_idx, nm_param), (trunk_idx, trunk_param) = first_conv[True], first_conv[False]
+        if nm_param[1:] == trunk_param[1:]:
+            op = partial(_fused_conv2d_op, nm_idx, trunk_idx, nm_param[0], nm_param[4], nm_param[5], not self.folded)
+            stem = (op, Plan(tuple(nm[1:]), tuple(trunk[1:]), tuple(head), None, None, fc))
 
-                nm_data = F.relu(nm_data)
-                nm_data = maxpool(nm_data, kernel_size=2, stride=2)
+        return Plan(tuple(nm), tuple(trunk), tuple(head), stem, (tuple(nm_layers), tuple(trunk_layers)), fc)
 
-                w, b = vars[4], vars[5]
-                nm_data = conv2d(nm_data, w, b)
-                w, b = vars[6], vars[7]
-                running_mean, running_var = self.vars_bn[2], self.vars_bn[3]
-                nm_data = F.batch_norm(nm_data, running_mean, running_var, weight=w, bias=b, training=True)
+    def _foldable_bn(self):
+        """
+        :return: (idx, bn_vars_idx, bn_idx) for every 'bn' right after a conv2d or linear layer of a config
+        without neuromodulation, with the vars indices of both layers and the vars_bn index of the bn
+        """
+        foldable = []
+        previous = None
+        idx = 0
+        bn_idx = 0
+        for name, param in self.config:
+            if name == 'bn' and previous is not None and not self.Neuromodulation:
+                foldable.append((previous, idx, bn_idx))
+            previous = idx if name in ['conv2d', 'linear'] else None
+            if name in ['conv2d', 'convt2d', 'linear', 'bn']:
+                idx += 2
+            if name == 'bn':
+                bn_idx += 2
+        return foldable
+
+    def export(self):
+        """
+        Inference copy of the model. Batch norms that use running statistics (bn_training=False) are folded into
+        the conv or linear layer before them. The neuromodulated network normalises every sample with its own
+        statistics, which cannot be folded into constant weights, but the biases of the convolutions before those
+        normalisations cancel out and are skipped. Call the copy with bn_training=False so that it does not write
+        running statistics either.
+        :return: Learner
+        """
+        net = copy.deepcopy(self)
+        with torch.no_grad():
+            for idx, bn_vars_idx, bn_idx in net._foldable_bn():
+                w, b = net.vars[idx], net.vars[idx + 1]
+                gamma, beta = net.vars[bn_vars_idx], net.vars[bn_vars_idx + 1]
+                running_mean, running_var = net.vars_bn[bn_idx], net.vars_bn[bn_idx + 1]
+                scale = gamma / torch.sqrt(running_var + 1e-5)
+                w.mul_(scale.view(-1, *([1] * (w.dim() - 1))))
+                b.copy_((b - running_mean) * scale + beta)
+        net.folded = True
+        net._plan = net._compile()
+        net._splits = {}
+        net._compiled = None
+        return net
+
+    def _split(self, layers):
+        """
+        Splits the plan after the first `layers` layers (counted as in vars, i.e. a weight and a bias per layer).
+        The split never goes past the representation, the head always stays in the suffix.
+        :return: (prefix, suffix); prefix holds the ops of every network that only depend on the first layers,
+        suffix is the Plan for the remaining ones
+        """
+        split = self._splits.get(layers)
+        if split is None:
+            plan = self._plan
+            prefix = []
+            rest = []
+            for ops, op_layers in zip((plan.nm, plan.trunk), plan.layers):
+                if ops is None:
+                    continue
+                cut = sum(layer < layers for layer in op_layers)
+                prefix.append(ops[:cut])
+                rest.append(ops[cut:])
+            if plan.nm is None:
+                suffix = Plan(None, rest[0], plan.head, None, None, None)
+            else:
+                suffix = Plan(rest[0], rest[1], plan.head, None, None, plan.fc)
+            split = (tuple(prefix), suffix)
+            self._splits[layers] = split
+        return split
 
-                nm_data = F.relu(nm_data)
-                nm_data = maxpool(nm_data, kernel_size=2, stride=2)
+    def compile_plan(self, **kwargs):
+        """
+        Hands the plan executor to torch.compile (PyTorch >= 2.0) so that its ops can be fused.
+        :param kwargs: passed on to torch.compile
+        :return: self
+        """
+        if not hasattr(torch, 'compile'):
+            logger.warning("torch.compile is not available; the plan keeps running eagerly")
+            return self
+        self._compiled = torch.compile(self._run_plan, **kwargs)
+        return self
 
-                w, b = vars[8], vars[9]
-                nm_data = conv2d(nm_data, w, b)
-                w, b = vars[10], vars[11]
-                running_mean, running_var = self.vars_bn[4], self.vars_bn[5]
-                nm_data = F.batch_norm(nm_data, running_mean, running_var, weight=w, bias=b, training=True)
-                nm_data = F.relu(nm_data)
-                # nm_data = maxpool(nm_data, kernel_size=2, stride=2)
+    def forward(self, x, tasks, vars=None, bn_training=True, feature=False):
+        """
+        This function can be called by finetunning, however, in finetunning, we dont wish to update
+        running_mean/running_var. Thought weights/bias of bn is updated, it has been separated by fast_weights.
+        Indeed, to not update running_mean/running_var, we need set update_bn_statistics=False
+        but weight/bias will be updated and not dirty initial theta parameters via fast_weiths.
+        :param x: [b, 1, 28, 28]
+        :param tasks: [b] task index of every sample, only used by the neuromodulated network when ksplit > 1
+        :param vars:
+        :param bn_training: set False to not update
+        :param feature: return the representation instead of the output
+        :return: x, loss, likelihood, kld
+        """
 
-                nm_data = nm_data.view(nm_data.size(0), 1008)
+        if vars is None:
+            vars = self.vars
 
-                # NM Output
+        run = self._compiled or self._run_plan
 
-                w, b = vars[12], vars[13]
-                fc_mask = torch.sigmoid(F.linear(nm_data, w, b)).view(nm_data.size(0), 2304)
+        if self.Neuromodulation and not self.batched:
+            outputs = []
+            closed = []
+            for i in range(x.size(0)):
+                outputs.append(run(x[i:i + 1], tasks[i:i + 1], vars, bn_training, feature))
+                closed.append(self._closed)
+            self._record_gates(closed)
+            return torch.cat(outputs, dim=0)
+
+        # Each sample is normalised on its own in the neuromodulated network, so the whole
+        # mini-batch can go through both networks in one pass
+        x = run(x, tasks, vars, bn_training, feature)
+        self._record_gates([self._closed])
+        return x
+
+    def _record_gates(self, closed):
+        """
+        Sets gate_sparsity and column_sparsity for the whole batch.
+        :param closed: closed gate masks of the batch, one per pass through _run_suffix (None if the gates were
+        not thresholded)
+        """
+        closed = [c for c in closed if c is not None]
+        if not closed:
+            return
+        closed = torch.cat(closed, dim=0)
+        self.gate_sparsity = closed.float().mean().item()
+        # Columns closed for every sample of the batch, the ones a batched pass skips
+        self.column_sparsity = 1 - (~closed).any(dim=0).sum().item() / closed.size(1)
+
+    def forward_prefix(self, x, layers, vars=None, bn_training=True):
+        """
+        Runs only the first `layers` layers, e.g. the frozen ones, so that their activations can be reused.
+        :param x: [b, 3, 28, 28] or [b, 1, 28, 28]
+        :param layers: number of layers (weight and bias pairs in vars) to run
+        :return: tuple with the activations of every network, to be passed to forward_suffix
+        """
+        if vars is None:
+            vars = self.vars
 
-                # =========== PREDICTION NETWORK ===========
+        prefix, suffix = self._split(layers)
+        if self.Neuromodulation:
+            x = x.view(x.size(0), -1, 28, 28)
+        return tuple(_run(ops, x, vars, self.vars_bn, bn_training) for ops in prefix)
 
-                # 'conv1'
-                # 'bn1'
-                # 'conv2'
-                # 'bn2'
-                # 'conv3'
-                # 'bn3'
-                # 'fc'
+    def forward_suffix(self, state, tasks, layers, vars=None, bn_training=True, feature=False):
+        """
+        Finishes a forward pass started by forward_prefix with the same number of layers.
+        :param state: tuple returned by forward_prefix
+        """
+        if vars is None:
+            vars = self.vars
 
-                w, b = vars[14], vars[15]
+        prefix, suffix = self._split(layers)
+        x = self._run_suffix(suffix, state, tasks, vars, bn_training, feature)
+        self._record_gates([self._closed])
+        return x
 
-                data = conv2d(data, w, b)
+    def _run_plan(self, x, tasks, vars, bn_training, feature):
+        plan = self._plan
 
-                w, b = vars[16], vars[17]
-                running_mean, running_var = self.vars_bn[6], self.vars_bn[7]
-                data = F.batch_norm(data, running_mean, running_var, weight=w, bias=b, training=True)
-                data = F.relu(data)
-                data = maxpool(data, kernel_size=2, stride=2)
+        if plan.nm is None:
+            return self._run_suffix(plan, (x,), tasks, vars, bn_training, feature)
 
-                w, b = vars[18], vars[19]
+        x = x.view(x.size(0), -1, 28, 28)
 
-                data = conv2d(data, w, b, stride=1)
-                w, b = vars[20], vars[21]
-                running_mean, running_var = self.vars_bn[8], self.vars_bn[9]
-                data = F.batch_norm(data, running_mean, running_var, weight=w, bias=b, training=True)
-                data = F.relu(data)
-                data = maxpool(data, kernel_size=2, stride=2)
+        if self.fuse_stem and plan.stem is not None:
+            stem, plan = plan.stem
+            state = stem(x, vars, self.vars_bn, bn_training)
+        else:
+            state = (x, x)
 
-                w, b = vars[22], vars[23]
+        return self._run_suffix(plan, state, tasks, vars, bn_training, feature)
 
-                data = conv2d(data, w, b, stride=1)
-                w, b, = vars[24], vars[25]
-                running_mean, running_var = self.vars_bn[10], self.vars_bn[11]
-                data = F.batch_norm(data, running_mean, running_var, weight=w, bias=b, training=True)
-                data = F.relu(data)
-                # data = maxpool(data, kernel_size=2, stride=2)
+    def _run_suffix(self, plan, state, tasks, vars, bn_training, feature):
 
-                data = data.view(data.size(0), 2304)  # nothing-max-max
-                data = data * fc_mask
+        if plan.nm is None:
+            x, = state
+            x = _run(plan.trunk, x, vars, self.vars_bn, bn_training)
+            if feature:
+                return x
+            return _run(plan.head, x, vars, self.vars_bn, bn_training)
 
-                w, b = vars[26], vars[27]
-                data = F.linear(data, w, b)
+        nm_data, data = state
+        self._closed = None
 
-                if self.ksplit > 1:
-                    task_mask = torch.zeros(1, 1000).to('cuda')
-                    task_mask[0][tasks[i] * self.ksplit % 1000: (tasks[i] * self.ksplit + self.ksplit) % 1000] = 1
-                    data = data * task_mask
+        # =========== NEUROMODULATORY NETWORK ===========
+        fc_mask = _run(plan.nm, nm_data, vars, self.vars_bn, bn_training)
 
-                try:
-                    prediction = torch.cat([prediction, data], dim=0)
-                except:
-                    prediction = data
+        # =========== PREDICTION NETWORK ===========
+        data = _run(plan.trunk, data, vars, self.vars_bn, bn_training)
 
+        if self.gate_threshold is not None and not feature:
+            closed = fc_mask < self.gate_threshold
+            w, b = vars[plan.fc], vars[plan.fc + 1]
+            data, _ = gated_linear(data, fc_mask, closed, w, b)
+            self._closed = closed
         else:
+            data = data * fc_mask
+            if feature:
+                return data
+            data = _run(plan.head, data, vars, self.vars_bn, bn_training)
 
-            for name, param in self.config:
-                # assert(name == "conv2d")
-                if name == 'conv2d':
-                    w, b = vars[idx], vars[idx + 1]
-                    x = F.conv2d(x, w, b, stride=param[4], padding=param[5])
-                    idx += 2
-                    # print(name, param, '\tout:', x.shape)
-                elif name == 'convt2d':
-                    w, b = vars[idx], vars[idx + 1]
-                    x = F.conv_transpose2d(x, w, b, stride=param[4], padding=param[5])
-                    idx += 2
-                elif name == 'linear':
-
-                    w, b = vars[idx], vars[idx + 1]
-                    x = F.linear(x, w, b)
-                    if cat_var:
-                        cat_list.append(x)
-                    idx += 2
-
-                elif name == 'rep':
-                    # print(x.shape)
-                    if feature:
-                        return x
-                elif name == "cat_start":
-                    cat_var = True
-                    cat_list = []
-
-                elif name == "cat":
-                    cat_var = False
-                    x = torch.cat(cat_list, dim=1)
-
-                elif name == 'bn':
-                    w, b = vars[idx], vars[idx + 1]
-                    running_mean, running_var = self.vars_bn[bn_idx], self.vars_bn[bn_idx + 1]
-                    x = F.batch_norm(x, running_mean, running_var, weight=w, bias=b, training=bn_training)
-                    idx += 2
-                    bn_idx += 2
-                elif name == 'flatten':
-                    # print(x.shape)
-
-                    x = x.view(x.size(0), -1)
-
-                elif name == 'reshape':
-                    # [b, 8] => [b, 2, 2, 2]
-                    x = x.view(x.size(0), *param)
-                elif name == 'relu':
-                    x = F.relu(x, inplace=param[0])
-                elif name == 'leakyrelu':
-                    x = F.leaky_relu(x, negative_slope=param[0], inplace=param[1])
-                elif name == 'tanh':
-                    x = F.tanh(x)
-                elif name == 'sigmoid':
-                    x = torch.sigmoid(x)
-                elif name == 'upsample':
-                    x = F.upsample_nearest(x, scale_factor=param[0])
-                elif name == 'max_pool2d':
-                    x = F.max_pool2d(x, param[0], param[1], param[2])
-                elif name == 'avg_pool2d':
-                    x = F.avg_pool2d(x, param[0], param[1], param[2])
+        if self.ksplit > 1:
+            data = data * self.task_masks[tasks.long()]
 
-                else:
-                    raise NotImplementedError
-
-        if self.Neuromodulation:
-            return (prediction)
-        else:
-            return (x)
+        return data
 
     def zero_grad(self, vars=None):
         """
@@ -1,16 +1,72 @@
 import logging
 import copy
+from functools import partial
 import numpy as np
 import torch
 from torch import nn
 from torch import optim
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 import matplotlib.pyplot as plt
 
 import model.learner as Learner
 
 logger = logging.getLogger("experiment")
 
+# Whether torch._foreach_add is differentiable in this PyTorch build, probed on first use
+_foreach_autograd = None
+
+
+def _foreach_supported():
+    global _foreach_autograd
+    if _foreach_autograd is None:
+        _foreach_autograd = False
+        if hasattr(torch, '_foreach_add'):
+            w = torch.zeros(1, requires_grad=True)
+            try:
+                _foreach_autograd = torch._foreach_add([w], [torch.ones(1)], alpha=-1.)[0].requires_grad
+            except RuntimeError:
+                pass
+    return _foreach_autograd
+
+
+class FastWeights(list):
+    """
+    Fast weights of a Learner: the tensors, in the order of its vars, and the indices of the adaptable ones. The
+    trainability is kept by the container, so new tensors do not have to be flagged with learn after every update.
+    """
+
+    def __init__(self, weights, adaptable):
+        super(FastWeights, self).__init__(weights)
+        self.adaptable = tuple(adaptable)
+
+    @classmethod
+    def from_parameters(cls, parameters):
+        """
+        :param parameters: vars of a Learner, with the learn flags set by utils.freeze_layers
+        """
+        return cls(parameters, [idx for idx, p in enumerate(parameters) if getattr(p, 'learn', True)])
+
+    def adaptable_weights(self):
+        return [self[idx] for idx in self.adaptable]
+
+    def step(self, grad, lr, foreach=True):
+        """
+        :param grad: gradients of the adaptable tensors, in the order of adaptable_weights
+        :param foreach: update all tensors with one multi-tensor op when autograd supports it
+        :return: FastWeights with w - lr * g for the adaptable tensors and the frozen ones unchanged
+        """
+        weights = self.adaptable_weights()
+        if foreach and _foreach_supported():
+            weights = torch._foreach_add(weights, list(grad), alpha=-lr)
+        else:
+            weights = [w - lr * g for w, g in zip(weights, grad)]
+
+        fast_weights = FastWeights(self, self.adaptable)
+        for idx, w in zip(self.adaptable, weights):
+            fast_weights[idx] = w
+        return fast_weights
+
 
 class MetaLearingClassification(nn.Module):
     """
@@ -24,6 +80,18 @@ class MetaLearingClassification(nn.Module):
         self.update_lr = args.update_lr
         self.meta_lr = args.meta_lr
         self.update_step = args.update_step
+        # How the meta-gradient goes through the inner updates, see differentiate_step
+        self.meta_grad = args.meta_grad
+        self.truncate_steps = args.truncate_steps
+        # Number of inner steps whose activations are recomputed together in the meta backward, 0 keeps them all
+        self.checkpoint_interval = args.grad_checkpoint_interval
+        if self.checkpoint_interval and self.meta_grad == 'first_order':
+            # First order keeps no activation of the inner steps for the meta backward, checkpointing
+            # would only run every segment twice
+            logger.warning("--grad_checkpoint_interval has no effect with --meta_grad first_order, ignored")
+            self.checkpoint_interval = 0
+        # Run the frozen layers once per meta step instead of once per inner step, see trajectory_loss
+        self.reuse_prefix = args.reuse_prefix
 
         if treatment == "Neuromodulation":
             neuromodulation = True
@@ -31,7 +99,8 @@ class MetaLearingClassification(nn.Module):
             neuromodulation = False
 
         self.ksplit = args.ksplit
-        self.net = Learner.Learner(config, self.ksplit, neuromodulation)
+        self.net = Learner.Learner(config, self.ksplit, neuromodulation, batched=args.batched,
+                                   fuse_stem=args.fuse_stem, gate_threshold=args.gate_threshold)
         self.optimizer = optim.Adam(self.net.parameters(), lr=self.meta_lr)
         self.meta_iteration = 0
         self.inputNM = True
@@ -43,6 +112,14 @@ class MetaLearingClassification(nn.Module):
         weight = self.net.parameters()[-2]
         torch.nn.init.kaiming_normal_(weight[class_to_reset].unsqueeze(0))
 
+    def reset_classes(self, y_traj):
+        """
+        Resets the classifier weights of every class of a trajectory (or stacked trajectories); this prevents the
+        learner from memorizing the data (which would kill the gradients due to inner updates)
+        """
+        for class_to_reset in y_traj.unique().tolist():
+            self.reset_classifer(class_to_reset)
+
     def reset_layer(self, layer_to_reset):
         if layer_to_reset % 2 == 0:
             weight = self.net.parameters()[layer_to_reset]#-2]
@@ -154,30 +231,169 @@ class MetaLearingClassification(nn.Module):
 
         return x_traj, y_traj, x_rand, y_rand
 
-    def inner_update(self, x, fast_weights, y, bn_training):
+    def differentiate_step(self, k):
+        """
+        :param k: index of the inner step
+        :return: whether the meta-gradient goes through the inner gradient of step k. With first_order, no inner
+        gradient is differentiated and every update counts as the identity for the meta-gradient; with full, all of
+        them are; with truncated, only the last truncate_steps ones, so memory stays bounded for long trajectories.
+        """
+        if self.meta_grad == 'full':
+            return True
+        if self.meta_grad == 'truncated':
+            return k >= self.update_step - self.truncate_steps
+        return False
 
-        logits = self.net(x, y//self.ksplit, fast_weights, bn_training=bn_training)
-        loss = F.cross_entropy(logits, y)
+    def adaptable(self):
+        """
+        Fast weights are split into the adaptable (TLN) tensors, flagged with learn by utils.freeze_layers, and the
+        frozen ones, which the inner updates pass through unchanged.
+        :return: indices in vars of the adaptable tensors
+        """
+        return list(FastWeights.from_parameters(self.net.parameters()).adaptable)
 
-        if fast_weights is None:
-            fast_weights = self.net.parameters()
+    def frozen_layers(self):
+        """
+        :return: number of leading layers (weight and bias pairs in vars) without any adaptable tensor
+        """
+        adaptable = self.adaptable()
+        return adaptable[0] // 2 if adaptable else len(self.net.parameters()) // 2
 
-        grad = torch.autograd.grad(loss, fast_weights, allow_unused=False)
+    def predict(self, x, fast_weights, y, bn_training, layers=None):
+        """
+        :param x: images, or with layers, the state returned by Learner.forward_prefix for them
+        """
+        if layers is None:
+            return self.net(x, y//self.ksplit, fast_weights, bn_training=bn_training)
+        return self.net.forward_suffix(x, y//self.ksplit, layers, fast_weights, bn_training=bn_training)
 
-        fast_weights = list(
-            map(lambda p: p[1] - self.update_lr * p[0] if p[1].learn else p[1], zip(grad, fast_weights)))
+    def inner_update(self, x, fast_weights, y, bn_training, create_graph=False, layers=None):
 
-        for params_old, params_new in zip(self.net.parameters(), fast_weights):
-            params_new.learn = params_old.learn
+        if fast_weights is None:
+            fast_weights = FastWeights.from_parameters(self.net.parameters())
+        if not fast_weights.adaptable:
+            # Every layer is frozen (e.g. --rln past the last layer), the inner update is the identity
+            return fast_weights
 
-        return fast_weights
+        logits = self.predict(x, fast_weights, y, bn_training, layers)
+        loss = F.cross_entropy(logits, y)
+
+        # Only the adaptable tensors are differentiated, so the backward stops at the first of them
+        grad = torch.autograd.grad(loss, fast_weights.adaptable_weights(), allow_unused=False,
+                                   create_graph=create_graph)
+
+        return fast_weights.step(grad, self.update_lr)
 
-    def meta_loss(self, x, fast_weights, y, bn_training):
+    def meta_loss(self, x, fast_weights, y, bn_training, layers=None):
 
-        logits = self.net(x, y//self.ksplit, fast_weights, bn_training=bn_training)
+        logits = self.predict(x, fast_weights, y, bn_training, layers)
         loss_q = F.cross_entropy(logits, y)
         return loss_q, logits
 
+    def adapt(self, vars, x_traj, y_traj, x_rand, y_rand, layers=None):
+        """
+        Inner loop and meta loss of one trajectory as a function of vars only. The inner gradients come from
+        torch.func.grad instead of torch.autograd.grad, so that it can be vmapped over the tasks of a meta-batch.
+        :param x_traj: [update_step, 1, ...] trajectory of one task, or with layers, the tuple of its prefix states
+        :param x_rand: [b, ...] random batch of the same task, or with layers, the tuple of its prefix states
+        :param layers: number of frozen layers already run by task_prefix_states
+        :return: meta loss, logits on x_rand
+        """
+        adaptable = self.adaptable()
+
+        def inner_loss(weights, fast_weights, x, y):
+            fast_weights = list(fast_weights)
+            for idx, w in zip(adaptable, weights):
+                fast_weights[idx] = w
+            logits = self.predict(x, fast_weights, y, False, layers)
+            return F.cross_entropy(logits, y)
+
+        fast_weights = FastWeights(vars, adaptable)
+        # Without adaptable tensors, every inner update is the identity (see inner_update)
+        for k in range(self.update_step if adaptable else 0):
+            x = x_traj[k] if layers is None else tuple(s[k] for s in x_traj)
+            # Differentiated with respect to the adaptable tensors only
+            grad = torch.func.grad(inner_loss)(fast_weights.adaptable_weights(), list(fast_weights), x, y_traj[k])
+            if not self.differentiate_step(k):
+                grad = [g.detach() for g in grad]
+            # Multi-tensor ops have no batching rule under vmap
+            fast_weights = fast_weights.step(grad, self.update_lr, foreach=False)
+
+        return self.meta_loss(x_rand, fast_weights, y_rand, False, layers)
+
+    def inner_steps(self, start, stop, x_traj, y_traj, layers, *fast_weights):
+        """
+        Inner updates start to stop - 1 of the trajectory. Fast weights go in and out as tensor arguments so that a
+        segment of steps can be checkpointed.
+        """
+        fast_weights = FastWeights(fast_weights, self.adaptable())
+        for k in range(start, stop):
+            # Doing inner updates using fast weights
+            fast_weights = self.inner_update(x_traj[k], fast_weights, y_traj[k], False, self.differentiate_step(k),
+                                             layers)
+        return tuple(fast_weights)
+
+    def prefix_states(self, x_traj, x_rand, layers):
+        """
+        Runs the frozen layers once over the whole trajectory and once over the random batch.
+        :return: list with the state of every inner step, state of the random batch
+        """
+        # Without any differentiated inner gradient, the trajectory only reaches the meta-gradient
+        # through the adaptable layers
+        differentiated = any(self.differentiate_step(k) for k in range(self.update_step))
+        with torch.set_grad_enabled(differentiated and torch.is_grad_enabled()):
+            state = self.net.forward_prefix(x_traj.view(-1, *x_traj.shape[2:]), layers, bn_training=False)
+        steps = x_traj.size(1)
+        x_traj = [tuple(s[k * steps:(k + 1) * steps] for s in state) for k in range(x_traj.size(0))]
+        return x_traj, self.net.forward_prefix(x_rand, layers, bn_training=False)
+
+    def task_prefix_states(self, x_traj, x_rand, layers):
+        """
+        prefix_states for a meta-batch, the frozen layers run once over the trajectories and random batches of all
+        tasks.
+        :param x_traj: [tasks, update_step, 1, ...]
+        :param x_rand: [tasks, b, ...]
+        :return: tuple of the trajectory states, [tasks, update_step, 1, ...] each, tuple of the random batch
+        states, [tasks, b, ...] each
+        """
+        differentiated = any(self.differentiate_step(k) for k in range(self.update_step))
+        with torch.set_grad_enabled(differentiated and torch.is_grad_enabled()):
+            state = self.net.forward_prefix(x_traj.reshape(-1, *x_traj.shape[3:]), layers, bn_training=False)
+        traj = tuple(s.view(*x_traj.shape[:3], *s.shape[1:]) for s in state)
+        state = self.net.forward_prefix(x_rand.reshape(-1, *x_rand.shape[2:]), layers, bn_training=False)
+        rand = tuple(s.view(*x_rand.shape[:2], *s.shape[1:]) for s in state)
+        return traj, rand
+
+    def trajectory_loss(self, x_traj, y_traj, x_rand, y_rand):
+        """
+        Inner updates over the trajectory followed by the meta loss on the random batch. With a checkpoint interval,
+        the activations of every segment of that many inner steps are dropped after the forward and recomputed
+        during the meta backward, trading compute for memory.
+        With reuse_prefix, the frozen layers run once over the stacked trajectory and random batch and the inner
+        updates and meta loss start from their activations.
+        :return: meta loss, logits on x_rand
+        """
+        fast_weights = tuple(self.net.parameters())
+
+        layers = None
+        if self.reuse_prefix:
+            layers = self.frozen_layers()
+            x_traj, x_rand = self.prefix_states(x_traj, x_rand, layers)
+
+        interval = self.checkpoint_interval or self.update_step
+        for start in range(0, self.update_step, interval):
+            stop = min(start + interval, self.update_step)
+            if self.checkpoint_interval:
+                # The non-reentrant variant runs the segment with autograd enabled, which the inner
+                # gradients need. Only the tensors go through it, inner_steps rebuilds the FastWeights
+                # container that knows which of them are adaptable
+                fast_weights = checkpoint(self.inner_steps, start, stop, x_traj, y_traj, layers, *fast_weights,
+                                          use_reentrant=False)
+            else:
+                fast_weights = self.inner_steps(start, stop, x_traj, y_traj, layers, *fast_weights)
+
+        return self.meta_loss(x_rand, list(fast_weights), y_rand, False, layers)
+
     def eval_accuracy(self, logits, y):
         pred_q = F.softmax(logits, dim=1).argmax(dim=1)
         correct = torch.eq(pred_q, y).sum().item()
@@ -210,13 +426,7 @@ class MetaLearingClassification(nn.Module):
                     #plt.imshow(x_rand[0][i][0,:,:])
                     #plt.show()
 
-        fast_weights = self.inner_update(x_traj[0], None, y_traj[0], False)
-        
-        for k in range(1, self.update_step):
-            # Doing inner updates using fast weights
-            fast_weights = self.inner_update(x_traj[k], fast_weights, y_traj[k], False)
-        
-        meta_loss, logits = self.meta_loss(x_rand[0], fast_weights, y_rand[0], False)
+        meta_loss, logits = self.trajectory_loss(x_traj, y_traj, x_rand[0], y_rand[0])
      
         with torch.no_grad():
             pred_q = F.softmax(logits, dim=1).argmax(dim=1)
@@ -249,6 +459,43 @@ class MetaLearingClassification(nn.Module):
 
         return classification_accuracy, meta_loss
 
+    def forward_tasks(self, x_traj, y_traj, x_rand, y_rand):
+        """
+        Meta-batch of independent trajectories stacked along a new first dimension, e.g. [tasks, update_step, 1, ...]
+        for x_traj. The inner loops run side by side with torch.func.vmap (PyTorch >= 2.0, one after the other
+        otherwise) and the mean of their meta losses is taken for a single outer step. With reuse_prefix, the frozen
+        layers run once for the whole meta-batch before the inner loops. With a checkpoint interval, the tasks are
+        run one after the other so that the inner steps of each are checkpointed.
+        :return: mean accuracy on the random batches, mean meta loss
+        """
+        # Checkpointed segments cannot be recomputed under vmap, the trajectories then go through
+        # trajectory_loss one by one
+        if hasattr(torch, 'func') and self.net.gate_threshold is None and not self.checkpoint_interval:
+            x_rand = x_rand[:, 0]
+            layers = None
+            if self.reuse_prefix:
+                # Outside of vmap, so that the frozen layers run as one batch for all tasks
+                layers = self.frozen_layers()
+                x_traj, x_rand = self.task_prefix_states(x_traj, x_rand, layers)
+            meta_loss, logits = torch.func.vmap(partial(self.adapt, layers=layers), in_dims=(None, 0, 0, 0, 0))(
+                list(self.net.parameters()), x_traj, y_traj, x_rand, y_rand[:, 0])
+        else:
+            meta_loss, logits = zip(*[self.trajectory_loss(x_traj[t], y_traj[t], x_rand[t, 0], y_rand[t, 0])
+                                      for t in range(x_traj.size(0))])
+            meta_loss, logits = torch.stack(meta_loss), torch.stack(logits)
+        meta_loss = meta_loss.mean()
+
+        with torch.no_grad():
+            classification_accuracy = torch.eq(logits.argmax(dim=2), y_rand[:, 0]).float().mean().item()
+
+        self.net.zero_grad()
+        meta_loss.backward()
+        self.optimizer.step()
+
+        self.meta_iteration += 1
+
+        return classification_accuracy, meta_loss
+
 
 class MetaLearnerRegression(nn.Module):
     """
@@ -280,12 +527,9 @@ class MetaLearnerRegression(nn.Module):
                 logits_select.append(logits[no, val])
             logits = torch.stack(logits_select).unsqueeze(1)
             loss = F.mse_loss(logits, y_traj[0, :, 0].unsqueeze(1))
-            grad = torch.autograd.grad(loss, self.net.parameters())
-
-            fast_weights = list(
-                map(lambda p: p[1] - self.update_lr * p[0] if p[1].learn else p[1], zip(grad, self.net.parameters())))
-            for params_old, params_new in zip(self.net.parameters(), fast_weights):
-                params_new.learn = params_old.learn
+            fast_weights = FastWeights.from_parameters(self.net.parameters())
+            grad = torch.autograd.grad(loss, fast_weights.adaptable_weights())
+            fast_weights = fast_weights.step(grad, self.update_lr)
 
             with torch.no_grad():
 
@@ -307,12 +551,8 @@ class MetaLearnerRegression(nn.Module):
                 logits = torch.stack(logits_select).unsqueeze(1)
 
                 loss = F.mse_loss(logits, y_traj[k, :, 0].unsqueeze(1))
-                grad = torch.autograd.grad(loss, fast_weights)
-                fast_weights = list(
-                    map(lambda p: p[1] - self.update_lr * p[0] if p[1].learn else p[1], zip(grad, fast_weights)))
-
-                for params_old, params_new in zip(self.net.parameters(), fast_weights):
-                    params_new.learn = params_old.learn
+                grad = torch.autograd.grad(loss, fast_weights.adaptable_weights())
+                fast_weights = fast_weights.step(grad, self.update_lr)
 
                 logits_q = self.net(x_rand[0, 0:int((k + 1) * len(x_rand[0]) / len(x_traj)), :], fast_weights,
                                     bn_training=False)
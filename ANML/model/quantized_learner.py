@@ -0,0 +1,191 @@
+import logging
+
+import numpy as np
+import torch
+from torch import nn
+
+import model.learner as Learner
+
+logger = logging.getLogger("experiment")
+
+
+def _conv2d(vars, idx, stride, padding, bias=True):
+    w = vars[idx].detach().cpu()
+    conv = nn.Conv2d(w.size(1), w.size(0), tuple(w.shape[2:]), stride=stride, padding=padding, bias=bias)
+    conv.weight.data.copy_(w)
+    if bias:
+        conv.bias.data.copy_(vars[idx + 1].detach())
+    return conv
+
+
+def _linear(vars, idx):
+    w = vars[idx].detach().cpu()
+    linear = nn.Linear(w.size(1), w.size(0))
+    linear.weight.data.copy_(w)
+    linear.bias.data.copy_(vars[idx + 1].detach())
+    return linear
+
+
+def _module(net, op):
+    """
+    :param op: op of a compiled Learner plan
+    :return: the equivalent nn.Module, with the parameters of net copied in
+    """
+    # Parameterless ops of the plan are bare functions, the others are partials
+    func, args = getattr(op, 'func', op), getattr(op, 'args', ())
+    vars = net.vars
+
+    if func is Learner._conv2d_op:
+        return _conv2d(vars, *args)
+    if func is Learner._conv2d_nobias_op:
+        return _conv2d(vars, *args, bias=False)
+    if func is Learner._linear_op:
+        return _linear(vars, *args)
+    if func is Learner._instancenorm_op:
+        idx, bn_idx = args
+        norm = nn.InstanceNorm2d(vars[idx].size(0), affine=True)
+        norm.weight.data.copy_(vars[idx].detach())
+        norm.bias.data.copy_(vars[idx + 1].detach())
+        return norm
+    if func is Learner._bn_op:
+        idx, bn_idx = args
+        norm = nn.BatchNorm2d(vars[idx].size(0))
+        norm.weight.data.copy_(vars[idx].detach())
+        norm.bias.data.copy_(vars[idx + 1].detach())
+        norm.running_mean.copy_(net.vars_bn[bn_idx].detach())
+        norm.running_var.copy_(net.vars_bn[bn_idx + 1].detach())
+        return norm
+    if func is Learner._relu_op:
+        return nn.ReLU()
+    if func is Learner._sigmoid_op:
+        return nn.Sigmoid()
+    if func is Learner._max_pool2d_op:
+        return nn.MaxPool2d(*args)
+    if func is Learner._avg_pool2d_op:
+        return nn.AvgPool2d(*args)
+    if func is Learner._flatten_op:
+        return nn.Flatten()
+
+    raise NotImplementedError(func.__name__)
+
+
+class QuantizedLearner(nn.Module):
+    """
+    Module copy of a Learner's compiled plan in the layout expected by eager mode post-training static quantization
+    (torch.quantization). Build it with quantize(); the converted model runs on the CPU with int8 weights and
+    activations and takes and returns float tensors on the caller's device.
+    """
+
+    def __init__(self, net):
+        """
+        :param net: Learner, usually the copy returned by its export
+        """
+        super(QuantizedLearner, self).__init__()
+
+        plan = net._plan
+        self.Neuromodulation = plan.nm is not None
+        self.ksplit = net.ksplit
+        # Read by the evaluation loops
+        self.gate_threshold = None
+        self.gate_sparsity = None
+        self.column_sparsity = None
+
+        self.quant = torch.quantization.QuantStub()
+        self.dequant = torch.quantization.DeQuantStub()
+        self.nm = nn.Sequential(*[_module(net, op) for op in plan.nm]) if self.Neuromodulation else None
+        self.trunk = nn.Sequential(*[_module(net, op) for op in plan.trunk])
+        self.head = nn.Sequential(*[_module(net, op) for op in plan.head])
+        convs = [m for m in self.trunk if isinstance(m, nn.Conv2d)]
+        self.in_channels = convs[0].in_channels if convs else 1
+        # Multiplication by the neuromodulatory gate
+        self.gate = nn.quantized.FloatFunctional()
+
+        task_masks = net.task_masks
+        self.register_buffer('task_masks', None if task_masks is None else task_masks.detach().cpu())
+
+    def fuse(self):
+        """
+        Fuses every conv or linear layer directly followed by a relu. The relu is replaced by an identity.
+        """
+        for seq in (self.nm, self.trunk, self.head):
+            if seq is None:
+                continue
+            pairs = [[str(i), str(i + 1)] for i in range(len(seq) - 1)
+                     if isinstance(seq[i], (nn.Conv2d, nn.Linear)) and isinstance(seq[i + 1], nn.ReLU)]
+            if pairs:
+                torch.quantization.fuse_modules(seq, pairs, inplace=True)
+        return self
+
+    def _input(self, x):
+        x = x.cpu()
+        if self.Neuromodulation:
+            x = x.view(x.size(0), -1, 28, 28)
+        if x.dim() == 4 and x.size(1) == 1 and self.in_channels > 1:
+            # Single channel images stand for identical channels (see datasets.omniglot_cache.expand); the
+            # quantized convolutions have fixed weights, so the channel is broadcast as a view instead
+            x = x.expand(-1, self.in_channels, -1, -1)
+        return x
+
+    def forward(self, x, tasks, vars=None, bn_training=False, feature=False):
+        """
+        Same interface as Learner.forward. The weights are baked into the quantized layers, so vars must be None,
+        and bn_training is ignored since there are no running statistics to update.
+        """
+        assert vars is None, "a quantized Learner has no fast weights"
+
+        device = x.device
+        x = self.quant(self._input(x))
+
+        data = self.trunk(x)
+        if self.Neuromodulation:
+            data = self.gate.mul(data, self.nm(x))
+        if feature:
+            return self.dequant(data).to(device)
+
+        data = self.dequant(self.head(data))
+        if self.Neuromodulation and self.ksplit > 1:
+            data = data * self.task_masks[tasks.long().cpu()]
+
+        return data.to(device)
+
+
+def calibration_set(dataset, size, seed=0):
+    """
+    :param dataset: Omniglot background set
+    :return: Subset with `size` random images of the dataset, the same ones for a given seed
+    """
+    rng = np.random.RandomState(seed)
+    indices = rng.choice(len(dataset), min(size, len(dataset)), replace=False)
+    return torch.utils.data.Subset(dataset, indices.tolist())
+
+
+def quantize(net, calibration, batch_size=64, backend=None, transform=None):
+    """
+    Post-training static quantization of a trained Learner.
+    :param net: Learner, left untouched
+    :param calibration: dataset of (img, target, ...) the activation ranges are observed on, see calibration_set
+    :param backend: quantized engine, torch.backends.quantized.engine by default (fbgemm on x86, qnnpack on ARM)
+    :param transform: applied to every batch of calibration images, e.g. datasets.omniglot_cache.expand
+    :return: QuantizedLearner with int8 weights and activations
+    """
+    if backend is None:
+        backend = torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+
+    qnet = QuantizedLearner(net.export())
+    qnet.eval()
+    qnet.fuse()
+    qnet.qconfig = torch.quantization.get_default_qconfig(backend)
+    torch.quantization.prepare(qnet, inplace=True)
+
+    iterator = torch.utils.data.DataLoader(calibration, batch_size=batch_size, shuffle=False, num_workers=1)
+    with torch.no_grad():
+        for img, *_ in iterator:
+            if transform is not None:
+                img = transform(img)
+            # The task masks are applied after dequantization, any task index does
+            qnet(img, torch.zeros(len(img), dtype=torch.long))
+
+    torch.quantization.convert(qnet, inplace=True)
+    logger.info("Quantized the model to int8 (%s), calibrated on %d images", backend, len(calibration))
+    return qnet
@@ -6,6 +6,8 @@ import torch
 from tensorboardX import SummaryWriter
 
 import datasets.datasetfactory as df
+import datasets.prefetcher as pf
+from datasets.omniglot_cache import collate, expand
 import datasets.task_sampler as ts
 import model.modelfactory as mf
 import utils.utils as utils
@@ -24,15 +26,21 @@ def main(args):
     logger = logging.getLogger('experiment')
 
 
-    dataset = df.DatasetFactory.get_dataset(args.dataset, ksplit=args.ksplit, background=True, train=True, all=True)
-    dataset_test = df.DatasetFactory.get_dataset(args.dataset, ksplit=args.ksplit, background=True, train=False, all=True)
+    dataset = df.DatasetFactory.get_dataset(args.dataset, ksplit=args.ksplit, background=True, train=True, all=True,
+                                            cache=args.dataset_cache, compact=args.compact_images,
+                                            deep_verify=args.deep_verify,
+                                            zip_storage=args.zip_storage)
+    dataset_test = df.DatasetFactory.get_dataset(args.dataset, ksplit=args.ksplit, background=True, train=False, all=True,
+                                                 cache=args.dataset_cache, compact=args.compact_images,
+                                                 deep_verify=args.deep_verify,
+                                                 zip_storage=args.zip_storage)
 
     # Iterators used for evaluation
     iterator_test = torch.utils.data.DataLoader(dataset_test, batch_size=5,
-                                                shuffle=True, num_workers=1)
+                                                shuffle=True, num_workers=1, collate_fn=collate)
 
     iterator_train = torch.utils.data.DataLoader(dataset, batch_size=5,
-                                                 shuffle=True, num_workers=1)
+                                                 shuffle=True, num_workers=1, collate_fn=collate)
 
     # Number of classes range depending on ksplit
     args.classes = list(range(np.max(dataset.targets)))
@@ -58,32 +66,62 @@ def main(args):
 
     utils.freeze_layers(args.rln, maml)
     
-    for step in range(args.steps):
-        #t1 = np.random.choice(args.classes, args.tasks, replace=False)
-        t1 = step % (np.max(dataset.targets))
+    episode_sampler = ts.EpisodeSampler(dataset, seed=args.seed) if args.tensor_sampler else None
 
-        d_traj_iterators = []
-        #for t in t1:
-        d_traj_iterators.append(sampler.sample_task([t1]))
+    def sample_episode(step):
+        #t1 = np.random.choice(args.classes, args.tasks, replace=False)
+        # One class trajectory per task of the meta-batch, walking through the classes in order
+        t1 = [(step * args.tasks + t) % (np.max(dataset.targets)) for t in range(args.tasks)]
+
+        episodes = []
+        for t in t1:
+            if episode_sampler is not None:
+                episodes.append(episode_sampler.sample([t], args.update_step))
+                continue
+            d_traj_iterators = [sampler.sample_task([t])]
+            d_rand_iterator = sampler.get_complete_iterator()
+            # The classifier is reset by the training loop, sampling may run ahead on another thread
+            episodes.append(maml.sample_training_data(d_traj_iterators, d_rand_iterator,
+                                                      steps=args.update_step, reset=False))
+
+        if args.tasks == 1:
+            return episodes[0]
+        return tuple(torch.stack(e) for e in zip(*episodes))
+
+    if args.prefetch > 0:
+        episodes = pf.EpisodePrefetcher(sample_episode, args.steps, args.prefetch,
+                                        pin_memory=torch.cuda.is_available())
+    else:
+        episodes = (sample_episode(step) for step in range(args.steps))
 
-        d_rand_iterator = sampler.get_complete_iterator()
+    for step, (x_spt, y_spt, x_qry, y_qry) in enumerate(episodes):
+        if not args.no_reset:
+            maml.reset_classes(y_spt)
 
-        x_spt, y_spt, x_qry, y_qry = maml.sample_training_data(d_traj_iterators, d_rand_iterator,
-                                                               steps=args.update_step, reset=not args.no_reset)
         if torch.cuda.is_available():
-            x_spt, y_spt, x_qry, y_qry = x_spt.cuda(), y_spt.cuda(), x_qry.cuda(), y_qry.cuda()
+            x_spt, y_spt = x_spt.cuda(non_blocking=True), y_spt.cuda(non_blocking=True)
+            x_qry, y_qry = x_qry.cuda(non_blocking=True), y_qry.cuda(non_blocking=True)
+        # Compact images are copied as uint8 and expanded on the device
+        x_spt, x_qry = expand(x_spt), expand(x_qry)
 
-        accs, loss = maml(x_spt, y_spt, x_qry, y_qry)#, args.tasks)
+        if args.tasks == 1:
+            accs, loss = maml(x_spt, y_spt, x_qry, y_qry)
+        else:
+            accs, loss = maml.forward_tasks(x_spt, y_spt, x_qry, y_qry)
 
         # Evaluation during training for sanity checks
         if step % 40 == 0:
             #writer.add_scalar('/metatrain/train/accuracy', accs, step)
             logger.info('step: %d \t training acc %s', step, str(accs))
+            if args.prefetch > 0:
+                starved, wait = episodes.starvation()
+                logger.info('episode queue starved on %.2f of the steps, mean wait %.4fs', starved, wait)
+                writer.add_scalar('/metatrain/prefetch/starvation', starved, step)
         if step % 100 == 0 or step == args.steps-1:
             torch.save(maml.net, args.model_name)
         if step % 2000 == 0 and step != 0:
-            utils.log_accuracy(maml, my_experiment, iterator_test, device, writer, step, args.ksplit)
-            utils.log_accuracy(maml, my_experiment, iterator_train, device, writer, step, args.ksplit)
+            utils.log_accuracy(maml, my_experiment, iterator_test, device, writer, step, args.ksplit, args.fold_bn)
+            utils.log_accuracy(maml, my_experiment, iterator_train, device, writer, step, args.ksplit, args.fold_bn)
 
 #
 if __name__ == '__main__':
@@ -100,11 +138,40 @@ if __name__ == '__main__':
     argparser.add_argument('--meta_lr', type=float, help='meta-level outer learning rate', default=1e-2)
     argparser.add_argument('--update_lr', type=float, help='task-level inner update learning rate', default=0.01)
     argparser.add_argument('--update_step', type=int, help='task-level inner update steps', default=20)
+    argparser.add_argument('--meta_grad', choices=['first_order', 'full', 'truncated'], default='first_order',
+                           help='differentiate no inner gradient, all of them, or the last --truncate_steps ones')
+    argparser.add_argument('--truncate_steps', type=int, help='inner steps differentiated by --meta_grad truncated',
+                           default=5)
+    argparser.add_argument('--grad_checkpoint_interval', type=int, default=0,
+                           help='recompute the activations of every segment of this many inner steps in the meta '
+                                'backward instead of keeping them, 0 to keep all. The recomputation runs the inner '
+                                'forward and gradients of the segment again. Only saves memory with --meta_grad full '
+                                'or truncated, ignored with first_order. With --tasks > 1 the tasks then run one '
+                                'after the other instead of vmapped')
+    argparser.add_argument("--reuse_prefix", action="store_true",
+                           help='run the frozen layers once per meta step over the whole trajectory')
+    argparser.add_argument('--prefetch', type=int, default=0,
+                           help='episodes sampled ahead on a background thread, 0 to sample synchronously')
+    argparser.add_argument("--tensor_sampler", action="store_true",
+                           help='sample episodes from the dataset held in one tensor instead of DataLoaders')
+    argparser.add_argument("--dataset_cache", action="store_true",
+                           help='read Omniglot from the preprocessed memory-mapped cache, built on first use')
+    argparser.add_argument("--zip_storage", action="store_true",
+                           help='read Omniglot straight from the zip files instead of extracting them')
+    argparser.add_argument("--deep_verify", action="store_true",
+                           help='hash the Omniglot zip files again even if they were verified before')
+    argparser.add_argument("--compact_images", action="store_true",
+                           help='keep Omniglot images as uint8 single channel arrays, see datasets.omniglot_cache')
     argparser.add_argument('--name', help='Name of experiment', default="mrcl_classification")
     argparser.add_argument('--dataset', help='Name of experiment', default="omniglot")
     argparser.add_argument("--commit", action="store_true")
     argparser.add_argument("--no-reset", action="store_true")
     argparser.add_argument("--rln", type=int, default=9)
+    argparser.add_argument("--batched", action="store_true", help='run the neuromodulated network on whole batches')
+    argparser.add_argument("--fuse_stem", action="store_true", help='fuse the first conv of the NM and prediction networks')
+    argparser.add_argument("--fold_bn", action="store_true", help='log accuracy with batch norms folded, see Learner.export')
+    argparser.add_argument('--gate_threshold', type=float, default=None,
+                           help='skip the fc inputs whose neuromodulatory gate is below this value')
     argparser.add_argument('--model', type=str, help='epoch number', default="none")
     args = argparser.parse_args()
 
@@ -12,6 +12,8 @@ import numpy as np
 transition = namedtuple('transition', 'state, next_state, action, reward, is_terminal')
 import torch
 
+from datasets.omniglot_cache import collate, expand
+
 def set_seed(seed):
     torch.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
@@ -39,17 +41,75 @@ def freeze_layers(layers_to_freeze, maml):
     #for a in list_of_names:
      #   logger.info("TLN layer = %s", a[0])
 
-def log_accuracy(maml, my_experiment, iterator_test, device, writer, step, split):
+def log_accuracy(maml, my_experiment, iterator_test, device, writer, step, split, fold=False):
+    net = maml.net.export() if fold else maml.net
     correct = 0
+    gate_sparsity = 0
+    column_sparsity = 0
     for img, target, charc, task in iterator_test:
         with torch.no_grad():
-            img = img.to(device)
+            img = expand(img.to(device))
             target = target.to(device)
-            logits_q = maml.net(img, target//split, vars=None, bn_training=False, feature=False)
+            logits_q = net(img, target//split, vars=None, bn_training=False, feature=False)
             pred_q = F.softmax(logits_q, dim=1).argmax(dim=1)
             correct += torch.eq(pred_q, target).sum().item() / len(img)
+            if net.gate_threshold is not None:
+                gate_sparsity += net.gate_sparsity
+                column_sparsity += net.column_sparsity
     writer.add_scalar('/metatrain/test/classifier/accuracy', correct / len(iterator_test), step)
     logger.info("Test Accuracy = %s", str(correct / len(iterator_test)))
+    if net.gate_threshold is not None:
+        writer.add_scalar('/metatrain/test/classifier/gate_sparsity', gate_sparsity / len(iterator_test), step)
+        writer.add_scalar('/metatrain/test/classifier/column_sparsity', column_sparsity / len(iterator_test), step)
+        logger.info("Gate sparsity = %s, skipped fc columns = %s", str(gate_sparsity / len(iterator_test)),
+                    str(column_sparsity / len(iterator_test)))
+
+
+class FeatureCache:
+    """
+    Activations of the first (frozen) layers of a Learner for every image of a dataset. They are computed once, so
+    fine-tuning and evaluation only have to run the trainable layers, see Learner.forward_suffix.
+    """
+
+    def __init__(self, net, dataset, layers, device, batch_size=64):
+        self.layers = layers
+
+        iterator = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=1,
+                                               collate_fn=collate)
+        states = []
+        targets = []
+        with torch.no_grad():
+            for img, target, charc, task in iterator:
+                states.append(net.forward_prefix(expand(img.to(device)), layers, bn_training=False))
+                targets.append(target.long().to(device))
+
+        # One tensor per network of the Learner, indexed like the dataset
+        self.states = tuple(torch.cat(state) for state in zip(*states))
+        self.targets = torch.cat(targets)
+        logger.info("Cached the first %d layers for %d images", layers, len(self.targets))
+
+    def __len__(self):
+        return len(self.targets)
+
+    def batches(self, batch_size=1, shuffle=False):
+        order = torch.randperm(len(self)) if shuffle else torch.arange(len(self))
+        order = order.to(self.targets.device)
+        for start in range(0, len(self), batch_size):
+            indices = order[start:start + batch_size]
+            yield tuple(state[indices] for state in self.states), self.targets[indices]
+
+    def accuracy(self, net, split, batch_size=256):
+        correct = 0
+        gate_sparsity = []
+        with torch.no_grad():
+            for state, target in self.batches(batch_size):
+                logits_q = net.forward_suffix(state, target // split, self.layers, bn_training=False)
+                correct += torch.eq(logits_q.argmax(dim=1), target).sum().item()
+                if net.gate_threshold is not None:
+                    gate_sparsity.append((net.gate_sparsity, net.column_sparsity))
+        if gate_sparsity:
+            logger.info("Gate sparsity = %s, skipped fc columns = %s", *map(str, np.mean(gate_sparsity, axis=0)))
+        return correct / len(self)
 
 
 class replay_buffer: